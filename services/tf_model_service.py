@@ -5,13 +5,23 @@ Service สำหรับโหลดและใช้งานโมเดล
 """
 
 import os
+import copy
 import json
+import time
+import mmap
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
 from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 import logging
 
+# ต้องตั้งก่อน TensorFlow ถูก import (ที่ไหนก็ตามใน process) —
+# เปิด kernel แบบ fused ของ oneDNN สำหรับ conv/BN/ReLU บน CPU
+os.environ.setdefault("TF_ENABLE_ONEDNN_OPTS", "1")
+
 try:
     import cv2
     OPENCV_AVAILABLE = True
@@ -28,14 +38,46 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# hash สำหรับ cache key — blake3/xxhash เร็วกว่า sha256 หลายเท่าบนไฟล์ภาพใหญ่ๆ
+# (เป็นแค่ cache key ไม่ใช่งาน security) fallback เป็น sha256 ถ้าไม่ได้ติดตั้ง
+try:
+    import blake3
+
+    def _fast_hash(buf) -> bytes:
+        return blake3.blake3(buf).digest()
+except ImportError:
+    try:
+        import xxhash
+
+        def _fast_hash(buf) -> bytes:
+            return xxhash.xxh3_128_digest(buf)
+    except ImportError:
+        def _fast_hash(buf) -> bytes:
+            return hashlib.sha256(buf).digest()
+
+
+def _file_digest(image_path: str) -> bytes:
+    """hash เนื้อไฟล์ผ่าน mmap — ไม่ต้อง copy ทั้งไฟล์เป็น bytes ก่อน hash"""
+    with open(image_path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _fast_hash(mm)
+        except ValueError:
+            # ไฟล์ว่าง mmap ไม่ได้
+            return _fast_hash(f.read())
+
 # ============================================
 # Model Configuration
 # ============================================
 BASE_DIR = Path("D:/pang/project/backend_fastapi")
 # ใช้โมเดล round3 ตามที่ระบบปัจจุบันใช้
 MODEL_PATH = BASE_DIR / "models" / "model_round3.h5"
+# TFLite ที่แปลงจาก .h5 แบบ offline ด้วย scripts/convert_model_tflite.py —
+# ไม่แปลงอัตโนมัติตอนโหลด เพราะ quantize ต้องใช้ชุดภาพ calibration จริง
+TFLITE_PATH = MODEL_PATH.with_suffix(".tflite")
 CLASS_NAMES_PATH = BASE_DIR / "models" / "class_names_round3.json"
 IMG_SIZE = 160  # ขนาดรูปภาพที่โมเดลต้องการ
+PREDICT_CACHE_SIZE = 512  # จำนวนผลทำนายที่ cache ไว้ในหน่วยความจำ
 
 # ============================================
 # Class Mapping (16 Classes)
@@ -140,14 +182,49 @@ CLASS_MAPPING = {
     },
 }
 
+def _category_masks(class_names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """สร้าง boolean mask (disease, pest) เรียงตามลำดับ class_names"""
+    disease_mask = np.array(
+        [CLASS_MAPPING.get(n, {}).get("category") == "disease" for n in class_names],
+        dtype=bool,
+    )
+    pest_mask = np.array(
+        [CLASS_MAPPING.get(n, {}).get("category") == "pest" for n in class_names],
+        dtype=bool,
+    )
+    return disease_mask, pest_mask
+
+
 class ResultValidator:
-    """Validator สำหรับตรวจสอบความสอดคล้องของผลการทำนาย"""
-    
-    DISEASE_LOOKING_LIKE_PEST = {"Leaf Spot Disease", "Leaf Blight", "Cercospora Leaf Spot"}
-    PEST_LOOKING_LIKE_DISEASE = {"Leaf Miner", "Flea Beetle"}
-    
-    @classmethod
-    def validate_prediction_consistency(cls, results: List[Dict], pred_probs: np.ndarray, class_names: List[str]) -> Dict:
+    """Validator สำหรับตรวจสอบความสอดคล้องของผลการทำนาย
+
+    สร้างครั้งเดียวตอนโหลดโมเดล (ผูกกับลำดับ class_names) แล้วใช้ mask
+    ที่คำนวณไว้แล้วทุก request — ไม่ต้อง derive โครงสร้างใหม่ต่อ call
+    """
+
+    DISEASE_LOOKING_LIKE_PEST = frozenset({"Leaf Spot Disease", "Leaf Blight", "Cercospora Leaf Spot"})
+    PEST_LOOKING_LIKE_DISEASE = frozenset({"Leaf Miner", "Flea Beetle"})
+
+    def __init__(self, class_names: List[str]):
+        self._disease_mask, self._pest_mask = _category_masks(class_names)
+        # เวอร์ชัน float32 ของ mask — รวม confidence เป็น dot product รอบเดียว
+        # (boolean fancy-index ต้อง gather เป็น array ใหม่ก่อนค่อย sum)
+        self._disease_vec = self._disease_mask.astype(np.float32)
+        self._pest_vec = self._pest_mask.astype(np.float32)
+        # index set ของคลาสที่มักสับสนกัน — เทียบเป็น int แทน hash string ทุก request
+        self._disease_lookalike_idx = {
+            i for i, n in enumerate(class_names) if n in self.DISEASE_LOOKING_LIKE_PEST
+        }
+        self._pest_lookalike_idx = {
+            i for i, n in enumerate(class_names) if n in self.PEST_LOOKING_LIKE_DISEASE
+        }
+        self._categories = [
+            CLASS_MAPPING.get(n, {}).get("category", "unknown") for n in class_names
+        ]
+
+    def validate_prediction_consistency(
+        self, results: List[Dict], pred_probs: np.ndarray, top_idx=None
+    ) -> Dict:
         if len(results) < 2:
             return {"is_consistent": True, "warnings": []}
         
@@ -159,7 +236,9 @@ class ResultValidator:
         secondary_category = secondary.get("category", "unknown")
         primary_conf = primary.get("confidence", 0)
         secondary_conf = secondary.get("confidence", 0)
-        
+        # หมวดที่โผล่ใน top 3 — สร้าง set ครั้งเดียวแทน scan ซ้ำสองรอบ
+        top_categories = {r.get("category") for r in results}
+
         category_conflict = (primary_category != secondary_category and 
                             primary_category in ["disease", "pest"] and
                             secondary_category in ["disease", "pest"])
@@ -170,15 +249,52 @@ class ResultValidator:
                 warnings.append({
                     "type": "category_conflict",
                     "level": "high",
-                    "message": f"โมเดลสับสนระหว่าง{cls._get_category_name(primary_category)}กับ{cls._get_category_name(secondary_category)}",
+                    "message": f"โมเดลสับสนระหว่าง{self._get_category_name(primary_category)}กับ{self._get_category_name(secondary_category)}",
                     "suggestion": "ควรถ่ายรูปเพิ่มหรือตรวจสอบด้วยตาเปล่า",
+                    "confidence_gap": round(float(confidence_gap), 3),
                 })
-        
-        # Calculate category confidence
-        disease_confidence = sum(float(pred_probs[i]) for i, name in enumerate(class_names) 
-                                if CLASS_MAPPING.get(name, {}).get("category") == "disease")
-        pest_confidence = sum(float(pred_probs[i]) for i, name in enumerate(class_names) 
-                             if CLASS_MAPPING.get(name, {}).get("category") == "pest")
+            elif confidence_gap < 0.30:
+                warnings.append({
+                    "type": "category_conflict",
+                    "level": "medium",
+                    "message": f"โมเดลอาจสับสนระหว่าง{self._get_category_name(primary_category)}กับ{self._get_category_name(secondary_category)}",
+                    "suggestion": "พิจารณาดูอาการเพิ่มเติม",
+                    "confidence_gap": round(float(confidence_gap), 3),
+                })
+
+        # ตรวจสอบว่า primary prediction เป็นคลาสที่มักสับสนกันหรือไม่
+        # (เทียบ index เป็น int ถ้า caller ส่ง top_idx มา — ไม่ต้อง hash string)
+        if top_idx is not None:
+            is_disease_lookalike = int(top_idx[0]) in self._disease_lookalike_idx
+            is_pest_lookalike = int(top_idx[0]) in self._pest_lookalike_idx
+        else:
+            primary_class = primary.get("class_name", "")
+            is_disease_lookalike = primary_class in self.DISEASE_LOOKING_LIKE_PEST
+            is_pest_lookalike = primary_class in self.PEST_LOOKING_LIKE_DISEASE
+
+        if is_disease_lookalike and primary_category == "disease":
+            if "pest" in top_categories:
+                warnings.append({
+                    "type": "look_alike",
+                    "level": "medium",
+                    "message": "อาการนี้อาจดูคล้ายแมลงกัด โปรดตรวจสอบว่ามีตัวแมลงหรือรอยกัดจริงหรือไม่",
+                    "suggestion": "ถ้าพบตัวแมลงหรือรูกัด อาจเป็นศัตรูพืชมากกว่าโรค",
+                })
+        elif is_pest_lookalike and primary_category == "pest":
+            if "disease" in top_categories:
+                warnings.append({
+                    "type": "look_alike",
+                    "level": "medium",
+                    "message": "อาการนี้อาจดูคล้ายโรคใบ โปรดตรวจสอบว่ามีตัวแมลงหรือไม่",
+                    "suggestion": "ถ้าไม่พบตัวแมลง อาจเป็นโรคใบมากกว่าศัตรูพืช",
+                })
+
+
+        # Calculate category confidence — dot product กับ mask vector (BLAS)
+        # แทน loop + dict lookup ต่อคลาสทุก request
+        probs32 = np.asarray(pred_probs, dtype=np.float32)
+        disease_confidence = float(probs32.dot(self._disease_vec))
+        pest_confidence = float(probs32.dot(self._pest_vec))
         
         return {
             "is_consistent": len(warnings) == 0,
@@ -186,6 +302,7 @@ class ResultValidator:
             "category_analysis": {
                 "disease_total_confidence": round(float(disease_confidence), 4),
                 "pest_total_confidence": round(float(pest_confidence), 4),
+                "predicted_category": primary_category,
                 "category_confidence_ratio": round(float(max(disease_confidence, pest_confidence) / (disease_confidence + pest_confidence + 1e-7)), 4),
             },
             "has_category_conflict": category_conflict,
@@ -195,26 +312,90 @@ class ResultValidator:
     def _get_category_name(category: str) -> str:
         return "โรคพืช" if category == "disease" else "ศัตรูพืช" if category == "pest" else category
 
+
+# กันชื่อใน look-alike set หลุดจาก CLASS_MAPPING อีก (เคยพิมพ์เป็น underscore
+# จน branch ตายทั้งก้อน) — ตรวจตั้งแต่ตอน import
+assert ResultValidator.DISEASE_LOOKING_LIKE_PEST <= CLASS_MAPPING.keys(), \
+    "DISEASE_LOOKING_LIKE_PEST มีชื่อคลาสที่ไม่อยู่ใน CLASS_MAPPING"
+assert ResultValidator.PEST_LOOKING_LIKE_DISEASE <= CLASS_MAPPING.keys(), \
+    "PEST_LOOKING_LIKE_DISEASE มีชื่อคลาสที่ไม่อยู่ใน CLASS_MAPPING"
+
+def _load_rgb(image_path: str) -> Image.Image:
+    """decode ภาพเป็น RGB — ใช้ cv2.imdecode ถ้ามี (เร็วกว่า PIL ฝั่ง Python)"""
+    if OPENCV_AVAILABLE:
+        try:
+            # mmap ไฟล์แล้ว decode จาก view ตรงๆ — ไม่ต้อง copy เนื้อไฟล์
+            # เป็น bytes/array ก่อน (np.fromfile อ่านทั้งไฟล์เข้า buffer ใหม่)
+            with open(image_path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    buf = np.frombuffer(mm, dtype=np.uint8)
+                    bgr = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+                    # ปล่อย view ก่อน mmap ปิด — ไม่งั้นเจอ BufferError
+                    # "cannot close exported pointers exist" ทุกภาพ
+                    del buf
+        except (OSError, ValueError, BufferError):
+            bgr = None
+        if bgr is not None:
+            return Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+    return Image.open(image_path).convert('RGB')
+
+
+_clahe = None
+
+
+def _get_clahe():
+    """CLAHE object สร้างครั้งเดียวใช้ซ้ำทุกภาพ"""
+    global _clahe
+    if _clahe is None:
+        _clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return _clahe
+
+
+def _resize_for_model(img: Image.Image) -> Image.Image:
+    """ย่อภาพเป็น IMG_SIZE — cv2.resize INTER_AREA (SIMD/threaded) ถ้ามี ไม่งั้น PIL LANCZOS"""
+    if img.size == (IMG_SIZE, IMG_SIZE):
+        return img
+    if OPENCV_AVAILABLE:
+        arr = cv2.resize(
+            np.asarray(img), (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_AREA
+        )
+        return Image.fromarray(arr)
+    return img.resize((IMG_SIZE, IMG_SIZE), Image.Resampling.LANCZOS)
+
+
 class ImagePreprocessor:
     """ตัวปรับแต่งรูปภาพสำหรับโมเดล"""
-    
+
     @staticmethod
     def preprocess_for_model(image_path: str, enhance: bool = True) -> Image.Image:
-        img = Image.open(image_path).convert('RGB')
+        # ย่อก่อนค่อยปรับแต่ง — enhance บนภาพ 160x160 (~600KB FP32)
+        # แทนภาพเต็มจากกล้องมือถือ (หลักร้อย MB ของ traffic FP32)
+        img = _resize_for_model(_load_rgb(image_path))
         if not enhance:
             return img
-        
+
         # ปรับ White Balance พื้นฐาน
         img_array = np.array(img).astype(np.float32)
-        avg = np.mean(img_array, axis=(0, 1))
+        avg = img_array.reshape(-1, 3).mean(0)
         img_array = np.clip(img_array * (np.mean(avg) / (avg + 1e-6)), 0, 255)
-        img = Image.fromarray(img_array.astype(np.uint8))
-        
-        # ปรับ Contrast & Sharpness
+        arr = img_array.astype(np.uint8)
+
+        if OPENCV_AVAILABLE:
+            # รวม autocontrast + contrast + sharpness เป็น CLAHE บน L channel
+            # + unsharp mask ครั้งเดียว (SIMD) แทน 3 รอบ PIL ที่เดินทั้งภาพทีละ op
+            lab = cv2.cvtColor(arr, cv2.COLOR_RGB2LAB)
+            lab[:, :, 0] = _get_clahe().apply(lab[:, :, 0])
+            arr = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
+            blur = cv2.GaussianBlur(arr, (0, 0), 1.0)
+            cv2.addWeighted(arr, 1.2, blur, -0.2, 0, dst=arr)
+            return Image.fromarray(arr)
+
+        # ปรับ Contrast & Sharpness (fallback เมื่อไม่มี OpenCV)
+        img = Image.fromarray(arr)
         img = ImageOps.autocontrast(img, cutoff=1)
         img = ImageEnhance.Contrast(img).enhance(1.1)
         img = ImageEnhance.Sharpness(img).enhance(1.2)
-        
+
         return img
 
 class TensorFlowModelService:
@@ -222,75 +403,202 @@ class TensorFlowModelService:
     _model = None
     _class_names = None
     _is_loaded = False
+    _lock = threading.Lock()
 
     def __new__(cls):
+        # double-checked locking — กัน 2 threads โหลดโมเดลพร้อมกัน
+        # (โมเดลซ้ำใน RAM + race ตอนสร้าง TF graph)
         if cls._instance is None:
-            cls._instance = super().__new__(cls)
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
         return cls._instance
 
     def __init__(self):
         if not self._is_loaded:
-            self.load_model()
+            with self._lock:
+                if not self._is_loaded:
+                    self.load_model()
 
     def load_model(self) -> bool:
         try:
             import tensorflow as tf
+
+            # จัดสรร thread pool ให้พอดีกับจำนวน worker — default ของ TF เปิด
+            # thread ต่อ core ทุก worker จนแย่ง CPU กันเอง (ตั้งได้เฉพาะก่อน TF init)
+            try:
+                workers = max(1, int(os.environ.get("UVICORN_WORKERS", "1")))
+                tf.config.threading.set_intra_op_parallelism_threads(
+                    max(1, (os.cpu_count() or 1) // workers)
+                )
+                tf.config.threading.set_inter_op_parallelism_threads(1)
+                tf.config.optimizer.set_jit(True)
+            except RuntimeError as e:
+                logger.warning(f"⚠️ ตั้งค่า TF threading ไม่ได้ (TF init ไปแล้ว): {e}")
+
+            from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
+            # bind ครั้งเดียวตอนโหลด — ไม่ต้อง import ซ้ำใน hot path ทุก request
+            self._preprocess_input = preprocess_input
+            # ผลทำนายเก่าใช้ไม่ได้เมื่อโหลดโมเดลใหม่
+            self._pred_cache = OrderedDict()
+            # predict ถูกเรียกพร้อมกันจากหลาย thread (asyncio.to_thread) —
+            # OrderedDict ไม่ thread-safe ต้อง serialize ทุกการอ่าน/เขียน cache
+            self._cache_lock = threading.Lock()
+            # buffer FP32 ใช้ซ้ำทุก call ของ preprocess_image — allocate ครั้งเดียว
+            self._scratch = np.empty((1, IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+            # buffer batch TTA (original + flip 2 แบบ) ใช้ซ้ำเช่นกัน
+            self._tta_batch = np.empty((3, IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+            # interpreter TFLite ไม่ thread-safe — serialize การ inference
+            self._infer_lock = threading.Lock()
             if not MODEL_PATH.exists():
                 logger.error(f"Model file not found: {MODEL_PATH}")
                 return False
 
             self._model = tf.keras.models.load_model(str(MODEL_PATH))
-            
+
+            # trace กราฟครั้งเดียวเป็น concrete function — ข้าม Keras dispatch
+            # ของ model.predict ทุก call (batch dim เปิดไว้เพราะ TTA ส่ง batch > 1)
+            self._infer = tf.function(
+                lambda x: self._model(x, training=False),
+                input_signature=[tf.TensorSpec((None, IMG_SIZE, IMG_SIZE, 3), tf.float32)],
+                jit_compile=True,
+            )
+            self._infer(tf.zeros((1, IMG_SIZE, IMG_SIZE, 3), tf.float32))
+
             if CLASS_NAMES_PATH.exists():
                 with open(CLASS_NAMES_PATH, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                     self._class_names = [data[str(i)] for i in range(len(data))]
             else:
                 self._class_names = list(CLASS_MAPPING.keys())
-            
+
+            # validator ผูกกับลำดับ class_names — mask รายหมวดคำนวณครั้งเดียวตอนโหลด
+            self._validator = ResultValidator(self._class_names)
+
+            # ตาราง metadata เรียงตาม class index — แทน dict lookup ซ้อนกันตอน predict
+            self._names_th = [CLASS_MAPPING.get(n, {}).get("name_th", n) for n in self._class_names]
+            self._names_en = [CLASS_MAPPING.get(n, {}).get("name_en", n) for n in self._class_names]
+            self._categories = [CLASS_MAPPING.get(n, {}).get("category", "unknown") for n in self._class_names]
+
+            # ใช้ TFLite interpreter ถ้ามีไฟล์ที่แปลง offline วางคู่ .h5 ไว้
+            # (แบบเดียวกับ tf_model_service_old) — inference เร็วกว่า Keras
+            # eager path มากบน CPU; ไม่แปลงอัตโนมัติเพราะ calibration ด้วย
+            # ข้อมูลสุ่มทำให้ผลทำนายเพี้ยนโดยไม่มีใครสังเกต
+            self._interpreter = None
+            if TFLITE_PATH.exists():
+                try:
+                    self._interpreter = tf.lite.Interpreter(
+                        model_path=str(TFLITE_PATH), num_threads=os.cpu_count()
+                    )
+                    self._interpreter.allocate_tensors()
+                    inp = self._interpreter.get_input_details()[0]
+                    out = self._interpreter.get_output_details()[0]
+                    self._tfl_input_index = inp["index"]
+                    self._tfl_output_index = out["index"]
+                    self._tfl_input_scale, self._tfl_input_zero = inp["quantization"]
+                    self._tfl_output_scale, self._tfl_output_zero = out["quantization"]
+                    logger.info(f"✅ ใช้ TFLite interpreter สำหรับ inference ({TFLITE_PATH.name})")
+                except Exception as e:
+                    logger.warning(f"⚠️ ใช้ TFLite ไม่ได้ จะ inference ผ่านโมเดล Keras ตามเดิม: {e}")
+                    self._interpreter = None
+            else:
+                logger.info(
+                    "🔍 ไม่พบไฟล์ TFLite — inference ผ่านโมเดล Keras "
+                    "(แปลงได้ด้วย scripts/convert_model_tflite.py)"
+                )
+
             self._is_loaded = True
+
+            # warmup — จ่ายค่ากราฟ/allocator ครั้งแรกตอน start แทน request แรกของผู้ใช้
+            # (เรียก 2 รอบให้ทั้ง tracing และ memory arena ถูก prime)
+            try:
+                t0 = time.perf_counter()
+                dummy = np.zeros((1, IMG_SIZE, IMG_SIZE, 3), dtype=np.float32)
+                self._infer_batch(dummy)
+                self._infer_batch(dummy)
+                logger.info(f"🔥 Warmup inference เสร็จใน {time.perf_counter() - t0:.2f}s")
+            except Exception as e:
+                logger.warning(f"⚠️ Warmup inference ล้มเหลว: {e}")
+
             return True
         except Exception as e:
             logger.error(f"Error loading model: {e}")
             return False
 
+    def _infer_batch(self, batch: np.ndarray) -> np.ndarray:
+        """จุดรวม inference — ใช้ TFLite ถ้ามี ไม่งั้นเรียก concrete function"""
+        with self._infer_lock:
+            return self._infer_batch_locked(batch)
+
+    def _infer_batch_locked(self, batch: np.ndarray) -> np.ndarray:
+        """ตัว inference จริง — caller ต้องถือ _infer_lock อยู่แล้ว"""
+        if self._interpreter is not None:
+            return self._infer_tflite(batch)
+        import tensorflow as tf
+        return self._infer(tf.constant(batch)).numpy()
+
+    def _infer_tflite(self, batch: np.ndarray) -> np.ndarray:
+        interp = self._interpreter
+        inp = interp.get_input_details()[0]
+        if tuple(inp["shape"]) != batch.shape:
+            interp.resize_tensor_input(self._tfl_input_index, batch.shape)
+            interp.allocate_tensors()
+
+        # quantize FP32 → INT8 เฉพาะโมเดล full-integer (scale != 0) —
+        # ไฟล์จาก dynamic-range quantization รับ FP32 ตรง ๆ
+        if self._tfl_input_scale:
+            q = np.clip(
+                np.round(batch / self._tfl_input_scale + self._tfl_input_zero), -128, 127
+            ).astype(np.int8)
+        else:
+            q = np.ascontiguousarray(batch, dtype=np.float32)
+        interp.set_tensor(self._tfl_input_index, q)
+        interp.invoke()
+        raw = interp.get_tensor(self._tfl_output_index)
+        if self._tfl_output_scale:
+            return (raw.astype(np.float32) - self._tfl_output_zero) * self._tfl_output_scale
+        return raw.astype(np.float32)
+
     def is_ready(self) -> bool:
         return self._is_loaded and self._model is not None
 
     def preprocess_image(self, image_path: str, enhance: bool = False) -> Optional[np.ndarray]:
         try:
-            from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
             img = ImagePreprocessor.preprocess_for_model(image_path, enhance=enhance)
-            img_resized = img.resize((IMG_SIZE, IMG_SIZE), Image.Resampling.LANCZOS)
-            img_array = np.array(img_resized, dtype=np.float32)
-            
-            # ใช้ preprocess_input ของ MobileNetV2 ตามที่ระบุว่าสำคัญ
-            img_array = preprocess_input(img_array)
-            return np.expand_dims(img_array, axis=0)
+            return np.asarray(_resize_for_model(img), dtype=np.uint8)
         except Exception as e:
             logger.error(f"Error preprocessing: {e}")
             return None
 
+    def _infer_single(self, src: np.ndarray) -> np.ndarray:
+        """preprocess MobileNetV2 (x/127.5 - 1) ลง scratch buffer แล้ว inference ในรอบเดียว
+
+        ต้องเติม buffer ใต้ lock เดียวกับ inference — routes เรียก predict ผ่าน
+        asyncio.to_thread พร้อมกันได้ ถ้าเติมนอก lock อีก thread จะเขียนทับ
+        buffer ก่อนที่ interpreter จะอ่านค่า
+        """
+        with self._infer_lock:
+            np.multiply(src, np.float32(1.0 / 127.5), out=self._scratch[0])
+            self._scratch[0] -= np.float32(1.0)
+            return self._infer_batch_locked(self._scratch)
+
     def predict_with_tta(self, image_path: str, enhance: bool = True) -> Optional[np.ndarray]:
         try:
             img = ImagePreprocessor.preprocess_for_model(image_path, enhance=enhance)
-            img_resized = img.resize((IMG_SIZE, IMG_SIZE), Image.Resampling.LANCZOS)
-            
-            all_preds = []
-            # Orignal, H-Flip, V-Flip
-            variants = [
-                img_resized,
-                img_resized.transpose(Image.FLIP_LEFT_RIGHT),
-                img_resized.transpose(Image.FLIP_TOP_BOTTOM)
-            ]
-            
-            from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
-            for v in variants:
-                arr = preprocess_input(np.array(v, dtype=np.float32))
-                pred = self._model.predict(np.expand_dims(arr, axis=0), verbose=0)
-                all_preds.append(pred[0])
-            
-            return np.mean(all_preds, axis=0)
+            img_resized = _resize_for_model(img)
+
+            # cast uint8→FP32 + preprocess ครั้งเดียว แล้วเติม flip ทั้งสองแบบ
+            # ลง batch buffer ที่ allocate ไว้แล้ว (ไม่มี allocation ใหม่ต่อ call)
+            # ต้องเติมใต้ lock เดียวกับ inference — buffer ใช้ร่วมกันข้าม thread
+            base = self._preprocess_input(np.asarray(img_resized, dtype=np.float32))
+            with self._infer_lock:
+                batch = self._tta_batch
+                batch[0] = base
+                batch[1] = base[:, ::-1, :]
+                batch[2] = base[::-1, :, :]
+                # รวม 3 variants เป็น batch เดียวแล้ว forward ครั้งเดียว
+                # (เดิม predict ทีละภาพ 3 รอบ = จ่าย overhead ฝั่ง Python/TF 3 เท่า)
+                return self._infer_batch_locked(batch).mean(axis=0)
         except Exception as e:
             logger.error(f"TTA Error: {e}")
             return None
@@ -304,26 +612,43 @@ class TensorFlowModelService:
     ) -> Optional[Dict]:
         if not self.is_ready(): return None
 
+        # ภาพเดิมที่ส่งมาวิเคราะห์ซ้ำ (retry / thumbnail / แชร์) ตอบจาก cache
+        # ได้เลยโดยไม่ต้อง forward pass ใหม่ — key จาก hash เนื้อไฟล์
+        cache_key = None
+        try:
+            cache_key = (_file_digest(image_path), use_tta, enhance, confidence_threshold)
+            with self._cache_lock:
+                cached = self._pred_cache.get(cache_key)
+                if cached is not None:
+                    self._pred_cache.move_to_end(cache_key)
+            if cached is not None:
+                # คืน copy — ถ้าคืน dict ใน cache ตรงๆ caller ที่แก้ผลลัพธ์
+                # จะแก้ค่าใน cache ให้ request ถัดไปด้วย
+                return copy.deepcopy(cached)
+        except OSError:
+            pass
+
         try:
             if use_tta:
                 pred_probs = self.predict_with_tta(image_path, enhance=enhance)
             else:
-                img_arr = self.preprocess_image(image_path, enhance=enhance)
-                if img_arr is None: return None
-                pred_probs = self._model.predict(img_arr, verbose=0)[0]
+                src = self.preprocess_image(image_path, enhance=enhance)
+                if src is None: return None
+                pred_probs = self._infer_single(src)[0]
 
-            top_3_idx = np.argsort(pred_probs)[-3:][::-1]
+            # partial top-3 ด้วย argpartition (O(N)) แล้วค่อย sort แค่ 3 ตัว
+            idx = np.argpartition(pred_probs, -3)[-3:]
+            top_3_idx = idx[np.argsort(pred_probs[idx])[::-1]]
             results = []
             for idx in top_3_idx:
-                name = self._class_names[idx]
-                info = CLASS_MAPPING.get(name, {})
+                conf = float(pred_probs[idx])
                 results.append({
-                    "class_name": name,
-                    "name_th": info.get("name_th", name),
-                    "name_en": info.get("name_en", name),
-                    "confidence": float(pred_probs[idx]),
-                    "confidence_percent": round(float(pred_probs[idx]) * 100, 2),
-                    "category": info.get("category", "unknown"),
+                    "class_name": self._class_names[idx],
+                    "name_th": self._names_th[idx],
+                    "name_en": self._names_en[idx],
+                    "confidence": conf,
+                    "confidence_percent": round(conf * 100, 2),
+                    "category": self._categories[idx],
                 })
 
             primary = results[0]
@@ -331,13 +656,15 @@ class TensorFlowModelService:
             # คำนวณความแตกต่างระหว่าง top 1 และ top 2
             uncertainty = float(pred_probs[top_3_idx[0]] - pred_probs[top_3_idx[1]])
             
-            validation = ResultValidator.validate_prediction_consistency(results, pred_probs, self._class_names)
+            validation = self._validator.validate_prediction_consistency(
+                results, pred_probs, top_idx=top_3_idx
+            )
 
             # ถ้าความมั่นใจต่ำกว่า threshold ถือว่าเป็นพืชสุขภาพดี (Healthy)
             if primary["confidence"] < confidence_threshold:
                 healthy_confidence = 1.0 - primary["confidence"]
-                
-                return {
+
+                return self._cache_result(cache_key, {
                     "success": True,
                     "is_detected": False,
                     "is_healthy": True,
@@ -357,10 +684,10 @@ class TensorFlowModelService:
                     "uncertainty_score": round(uncertainty, 4),
                     "message": "ไม่พบโรคหรือศัตรูพืชในภาพ",
                     "detected_class_id": None
-                }
+                })
 
             # ตรวจพบโรค/ศัตรูพืช - ตอบตามผลลัพธ์โดยไม่มี uncertain
-            return {
+            return self._cache_result(cache_key, {
                 "success": True,
                 "is_detected": True,
                 "is_healthy": False,
@@ -374,11 +701,21 @@ class TensorFlowModelService:
                 "validation": validation,
                 "uncertainty_score": round(uncertainty, 4),
                 "message": f"ตรวจพบ{primary.get('name_th', 'ไม่ระบุ')}"
-            }
+            })
         except Exception as e:
             logger.error(f"Predict error: {e}")
             return {"success": False, "error": str(e)}
 
+    def _cache_result(self, cache_key, result: Dict) -> Dict:
+        """เก็บผลทำนายลง LRU cache (ตัดตัวเก่าสุดออกเมื่อเกิน PREDICT_CACHE_SIZE)"""
+        if cache_key is not None:
+            with self._cache_lock:
+                # เก็บ copy แยกจาก dict ที่คืนให้ caller ด้วยเหตุผลเดียวกับตอนอ่าน
+                self._pred_cache[cache_key] = copy.deepcopy(result)
+                if len(self._pred_cache) > PREDICT_CACHE_SIZE:
+                    self._pred_cache.popitem(last=False)
+        return result
+
     def get_model_info(self) -> Dict:
         return {"loaded": self.is_ready(), "model": "model_round3.h5"}
 
@@ -4,22 +4,182 @@ Telegram Bot Handler
 """
 
 import os
-import random
+import atexit
+import asyncio
+import secrets
 import string
 import logging
+import orjson
 import requests
-from datetime import datetime, timedelta
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Optional
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from pymongo import WriteConcern
 from database import get_collection
 
+# รหัสยืนยันสร้างใหม่ได้เสมอ — ไม่ต้องรอ journal sync (j=False) บน critical
+# path ของ /start ลด p99 latency ของการตอบกลับ
+_TEMP_CODE_WC = WriteConcern(w=1, j=False)
+
 logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 
+# Session ใช้ร่วมกันทั้ง module — keep-alive + connection pool แทนการเปิด
+# TCP+TLS ใหม่ทุกครั้งที่เรียก API (เสีย handshake ~1 RTT + crypto ต่อ call)
+# พร้อม retry อัตโนมัติเมื่อเจอ rate limit / server error ชั่วคราว
+_session = requests.Session()
+_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=2,
+            status=2,
+            backoff_factor=0.25,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # retry POST ด้วย (idempotent พอสำหรับ bot API)
+            allowed_methods={"POST", "GET"},
+        ),
+    ),
+)
+atexit.register(_session.close)
+
+# serialize payload ด้วย orjson (C extension) แทน json.dumps ฝั่ง Python
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _post_json(url: str, payload: dict) -> dict:
+    """POST payload ผ่าน session (retry ระดับ transport อยู่ที่ adapter แล้ว)"""
+    response = _session.post(
+        url, data=orjson.dumps(payload), headers=_JSON_HEADERS, timeout=10
+    )
+    return response.json()
+
+# HTTP client แบบ async ใช้ร่วมกันทั้ง process (keep-alive / connection pool)
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        )
+    return _async_client
+
+
+# ── Outbox queue ─────────────────────────────────────────────
+# ข้อความขาออกเข้าคิวแล้วให้ worker drain ตาม rate limit ของ Telegram
+# (~30 ข้อความ/วินาทีต่อ bot) — burst ของ /start ไม่ serialize ทีละ RTT
+# และโดน 429 ก็ backoff ตาม retry_after ที่ API บอกมา
+_outbox: "asyncio.Queue" = asyncio.Queue(maxsize=10000)
+_sender_tasks: list = []
+_SENDER_WORKERS = 4
+_RATE_LIMIT = 30  # ข้อความ/วินาที
+
+
+def queue_message(chat_id: str, text: str, parse_mode="Markdown") -> bool:
+    """เข้าคิวส่งข้อความ (ไม่ block) — ส่งจริงโดย sender worker"""
+    try:
+        _outbox.put_nowait((chat_id, text, parse_mode))
+        return True
+    except asyncio.QueueFull:
+        logger.warning(f"⚠️  outbox เต็ม — ทิ้งข้อความถึง chat_id={chat_id}")
+        return False
+
+
+async def _sender_worker():
+    """drain outbox ทีละข้อความ พร้อม pacing + backoff เมื่อโดน 429"""
+    while True:
+        chat_id, text, parse_mode = await _outbox.get()
+        try:
+            client = _get_async_client()
+            payload = {
+                "chat_id": chat_id,
+                "text": text,
+                "parse_mode": parse_mode,
+                "disable_web_page_preview": False
+            }
+            response = await client.post(
+                f"{TELEGRAM_API_URL}/sendMessage",
+                content=orjson.dumps(payload),
+                headers=_JSON_HEADERS,
+            )
+            if response.status_code == 429:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+                logger.warning(f"🕒 โดน rate limit — รอ {retry_after}s แล้วเข้าคิวใหม่")
+                await asyncio.sleep(retry_after)
+                queue_message(chat_id, text, parse_mode)
+            else:
+                result = response.json()
+                if result.get("ok"):
+                    logger.debug(f"✉️  ส่งข้อความถึง chat_id={chat_id} สำเร็จ (outbox)")
+                else:
+                    logger.warning(
+                        f"⚠️  ส่งข้อความล้มเหลว chat_id={chat_id}: {result.get('description')}"
+                    )
+            # เว้นจังหวะให้ยอดรวมทุก worker ไม่เกิน _RATE_LIMIT ต่อวินาที
+            await asyncio.sleep(_SENDER_WORKERS / _RATE_LIMIT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌ Exception ใน sender worker (chat_id={chat_id}): {e}")
+        finally:
+            _outbox.task_done()
+
+
+def start_sender_workers():
+    """เปิด sender worker — เรียกครั้งเดียวตอน startup (ต้องมี event loop)"""
+    if not _sender_tasks:
+        for _ in range(_SENDER_WORKERS):
+            _sender_tasks.append(asyncio.create_task(_sender_worker()))
+        logger.info(f"✅ เปิด Telegram sender worker {_SENDER_WORKERS} ตัว")
+
+
+async def stop_sender_workers():
+    """หยุด sender worker ตอน shutdown — drain คิวก่อน cancel
+
+    ข้อความใน outbox คือ reply ที่รับมาแล้ว (handler ตอบ 200 ไปแล้ว) —
+    ถ้า cancel ทิ้งเลยข้อความจะหายเงียบๆ จึงรอคิวว่างก่อนแบบมีเพดานเวลา
+    """
+    if not _sender_tasks:
+        return
+    try:
+        await asyncio.wait_for(_outbox.join(), timeout=10)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️  shutdown: drain outbox ไม่ทัน เหลือค้าง {_outbox.qsize()} ข้อความ")
+    for task in _sender_tasks:
+        task.cancel()
+    await asyncio.gather(*_sender_tasks, return_exceptions=True)
+    _sender_tasks.clear()
+
+
+# ตาราง alphabet สร้างครั้งเดียวตอน import — ไม่ต้อง concat string ทุก call
+_CODE_ALPHABET = (string.ascii_uppercase + string.digits).encode()
+_CODE_MASK = 63  # power of two ถัดไปของ 36 สำหรับ rejection sampling
+
 
 def generate_verification_code(length=6):
-    """สร้างรหัสยืนยันแบบสุ่ม"""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    """สร้างรหัสยืนยันแบบสุ่ม (ใช้ CSPRNG — รหัสยืนยันไม่ควรเดาได้)"""
+    out = bytearray()
+    while len(out) < length:
+        # mask แล้วคัดทิ้งค่าที่เกินขนาด alphabet เพื่อคงการกระจายสม่ำเสมอ
+        for b in secrets.token_bytes(length * 2):
+            i = b & _CODE_MASK
+            if i < len(_CODE_ALPHABET):
+                out.append(_CODE_ALPHABET[i])
+                if len(out) >= length:
+                    break
+    return out.decode()
 
 
 def send_message(chat_id: str, text: str, parse_mode="Markdown"):
@@ -42,26 +202,71 @@ def send_message(chat_id: str, text: str, parse_mode="Markdown"):
             "parse_mode": parse_mode,
             "disable_web_page_preview": False
         }
-        response = requests.post(url, json=payload, timeout=10)
+        result = _post_json(url, payload)
+
+        if result.get("ok"):
+            logger.debug(f"✉️  ส่งข้อความถึง chat_id={chat_id} สำเร็จ")
+            return True
+
+        description = (result.get("description") or "").lower()
+        logger.warning(f"⚠️  ส่งข้อความล้มเหลว chat_id={chat_id}: {result.get('description')}")
+        # fallback เป็น plain text เฉพาะปัญหา parse Markdown —
+        # transport error (timeout/5xx/429) จัดการโดย Retry ของ adapter แล้ว
+        if parse_mode != "" and ("parse" in description or "markdown" in description):
+            logger.info(f"🔄 Retry ส่งข้อความแบบ plain text ถึง chat_id={chat_id}")
+            payload["parse_mode"] = ""
+            result = _post_json(url, payload)
+            if result.get("ok"):
+                logger.debug(f"✉️  Retry สำเร็จ chat_id={chat_id}")
+            else:
+                logger.error(f"❌ Retry ล้มเหลว chat_id={chat_id}: {result.get('description')}")
+            return result.get("ok", False)
+        return False
+    except Exception as e:
+        logger.exception(f"❌ Exception ขณะส่งข้อความถึง chat_id={chat_id}: {e}")
+        return False
+
+
+async def send_message_async(chat_id: str, text: str, parse_mode="Markdown"):
+    """ส่งข้อความไปยัง Telegram แบบ async (ไม่ block event loop)
+
+    ใช้จาก coroutine เช่น scheduler/webhook handler — ระหว่างรอ Telegram ตอบ
+    event loop ยังประมวลผลงานอื่นต่อได้ และ fan-out หลายข้อความพร้อมกันได้
+    ด้วย asyncio.gather
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_BOT_TOKEN ไม่ได้ตั้งค่าใน .env")
+        return False
+
+    try:
+        url = f"{TELEGRAM_API_URL}/sendMessage"
+        payload = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "disable_web_page_preview": False
+        }
+        client = _get_async_client()
+        response = await client.post(url, content=orjson.dumps(payload), headers=_JSON_HEADERS)
         result = response.json()
-        
+
         if result.get("ok"):
             logger.debug(f"✉️  ส่งข้อความถึง chat_id={chat_id} สำเร็จ")
             return True
-        else:
-            logger.warning(f"⚠️  ส่งข้อความล้มเหลว chat_id={chat_id}: {result.get('description')}")
-            # ถ้า Markdown ไม่สำเร็จ ลองส่งแบบไม่มี parse_mode
-            if parse_mode != "":
-                logger.info(f"🔄 Retry ส่งข้อความแบบ plain text ถึง chat_id={chat_id}")
-                payload["parse_mode"] = ""
-                response = requests.post(url, json=payload, timeout=10)
-                result = response.json()
-                if result.get("ok"):
-                    logger.debug(f"✉️  Retry สำเร็จ chat_id={chat_id}")
-                else:
-                    logger.error(f"❌ Retry ล้มเหลว chat_id={chat_id}: {result.get('description')}")
-                return result.get("ok", False)
-            return False
+
+        logger.warning(f"⚠️  ส่งข้อความล้มเหลว chat_id={chat_id}: {result.get('description')}")
+        # ถ้า Markdown ไม่สำเร็จ ลองส่งแบบไม่มี parse_mode
+        if parse_mode != "":
+            logger.info(f"🔄 Retry ส่งข้อความแบบ plain text ถึง chat_id={chat_id}")
+            payload["parse_mode"] = ""
+            response = await client.post(url, content=orjson.dumps(payload), headers=_JSON_HEADERS)
+            result = response.json()
+            if result.get("ok"):
+                logger.debug(f"✉️  Retry สำเร็จ chat_id={chat_id}")
+            else:
+                logger.error(f"❌ Retry ล้มเหลว chat_id={chat_id}: {result.get('description')}")
+            return result.get("ok", False)
+        return False
     except Exception as e:
         logger.exception(f"❌ Exception ขณะส่งข้อความถึง chat_id={chat_id}: {e}")
         return False
@@ -76,18 +281,23 @@ async def handle_start(chat_id: str, user_info: dict):
     verification_code = generate_verification_code()
     
     # บันทึกรหัสลงฐานข้อมูลชั่วคราว (รอให้ผู้ใช้ยืนยันบนเว็บ)
-    temp_codes_collection = get_collection("telegram_temp_codes")
-    
+    temp_codes_collection = get_collection("telegram_temp_codes").with_options(
+        write_concern=_TEMP_CODE_WC
+    )
+
+    # เรียกนาฬิกาครั้งเดียว (utcnow deprecated ตั้งแต่ 3.12 — ใช้ aware UTC)
+    now = datetime.now(timezone.utc)
     await temp_codes_collection.update_one(
         {"chat_id": chat_id},
         {
+            # created_at เขียนเฉพาะตอน insert — /start ซ้ำไม่ทับเวลาเดิม
+            "$setOnInsert": {"created_at": now},
             "$set": {
                 "chat_id": chat_id,
                 "username": username,
                 "first_name": first_name,
                 "verification_code": verification_code,
-                "created_at": datetime.utcnow(),
-                "expires_at": datetime.utcnow() + timedelta(minutes=10),
+                "expires_at": now + timedelta(minutes=10),
                 "verified": False
             }
         },
@@ -108,12 +318,11 @@ async def handle_start(chat_id: str, user_info: dict):
 
 👉 @vegetableproject_chatbot"""
     
-    send_message(chat_id, message)
+    queue_message(chat_id, message)
 
 
-async def handle_help(chat_id: str):
-    """จัดการคำสั่ง /help"""
-    message = f"""*📖 คำสั่งที่ใช้ได้*
+# ข้อความ /help คงที่ — render ครั้งเดียวตอน import แทนสร้างใหม่ทุก call
+_HELP_TEXT = """*📖 คำสั่งที่ใช้ได้*
 
 /start - ขอรหัสยืนยันการเชื่อมต่อ
 /help - แสดงคำสั่งทั้งหมด
@@ -121,14 +330,25 @@ async def handle_help(chat_id: str):
 /test - ทดสอบการแจ้งเตือน
 
 *💡 วิธีใช้งาน*
-1\. พิมพ์ /start เพื่อรับรหัสยืนยัน
-2\. นำรหัสไปกรอกในหน้าเว็บ Vegetable Project
-3\. รอรับการแจ้งเตือนจากระบบ
+1\\. พิมพ์ /start เพื่อรับรหัสยืนยัน
+2\\. นำรหัสไปกรอกในหน้าเว็บ Vegetable Project
+3\\. รอรับการแจ้งเตือนจากระบบ
 
 *🆘 ต้องการความช่วยเหลือ?*
 ติดต่อผู้ดูแลระบบ"""
-    
-    send_message(chat_id, message)
+
+# ส่วนคงที่ของข้อความ "ไม่เข้าใจคำสั่ง" (เหลือแค่ต่อ text ของผู้ใช้)
+_UNKNOWN_PREFIX = """*❓ ไม่เข้าใจคำสั่ง*
+
+ข้อความ \""""
+_UNKNOWN_SUFFIX = """\" ไม่ใช่คำสั่งที่รองรับ
+
+พิมพ์ /help เพื่อดูคำสั่งทั้งหมด"""
+
+
+async def handle_help(chat_id: str):
+    """จัดการคำสั่ง /help"""
+    queue_message(chat_id, _HELP_TEXT)
 
 
 async def handle_status(chat_id: str):
@@ -162,7 +382,7 @@ User ID: `{user_id}`
 กรุณาพิมพ์ /start เพื่อขอรหัสยืนยัน
 และนำรหัสไปกรอกในหน้าเว็บ Vegetable Project"""
     
-    send_message(chat_id, message)
+    queue_message(chat_id, message)
 
 
 async def handle_test(chat_id: str):
@@ -173,20 +393,23 @@ async def handle_test(chat_id: str):
 
 หากคุณเห็นข้อความนี้ แสดงว่าการแจ้งเตือนทำงานปกติ ✅
 
-_เวลา: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC_"""
+_เวลา: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')} UTC_"""
     
-    send_message(chat_id, message)
+    queue_message(chat_id, message)
 
 
 async def handle_unknown(chat_id: str, text: str):
     """จัดการข้อความที่ไม่รู้จัก"""
-    message = f"""*❓ ไม่เข้าใจคำสั่ง*
+    queue_message(chat_id, _UNKNOWN_PREFIX + text + _UNKNOWN_SUFFIX)
 
-ข้อความ "{text}" ไม่ใช่คำสั่งที่รองรับ
 
-พิมพ์ /help เพื่อดูคำสั่งทั้งหมด"""
-    
-    send_message(chat_id, message)
+# ตารางคำสั่ง → handler (hash lookup O(1) แทนไล่เทียบ if/elif ทีละคำสั่ง)
+_DISPATCH = {
+    "/start": lambda chat_id, user_info, text: handle_start(chat_id, user_info),
+    "/help": lambda chat_id, user_info, text: handle_help(chat_id),
+    "/status": lambda chat_id, user_info, text: handle_status(chat_id),
+    "/test": lambda chat_id, user_info, text: handle_test(chat_id),
+}
 
 
 async def process_update(update: dict):
@@ -223,17 +446,13 @@ async def process_update(update: dict):
     
     # จัดการคำสั่ง
     if text.startswith("/"):
-        command = text.split()[0].lower()
+        # split แค่ token แรก — ไม่ต้องแตกข้อความทั้งก้อน
+        command = text.split(None, 1)[0].lower()
         logger.info(f"⚙️  คำสั่ง '{command}' จาก chat_id={chat_id}")
-        
-        if command == "/start":
-            await handle_start(chat_id, user_info)
-        elif command == "/help":
-            await handle_help(chat_id)
-        elif command == "/status":
-            await handle_status(chat_id)
-        elif command == "/test":
-            await handle_test(chat_id)
+
+        handler = _DISPATCH.get(command)
+        if handler is not None:
+            await handler(chat_id, user_info, text)
         else:
             logger.warning(f"❓ ไม่รู้จักคำสั่ง '{command}' จาก chat_id={chat_id}")
             await handle_unknown(chat_id, text)
@@ -258,9 +477,8 @@ async def set_webhook(webhook_url: str):
             "url": webhook_url,
             "allowed_updates": ["message"]
         }
-        response = requests.post(url, json=payload, timeout=10)
-        result = response.json()
-        
+        result = _post_json(url, payload)
+
         if result.get("ok"):
             logger.info(f"✅ ตั้งค่า Telegram webhook สำเร็จ: {webhook_url}")
             return True
@@ -283,7 +501,7 @@ async def delete_webhook():
     logger.info("🗑️  กำลังลบ Telegram webhook...")
     try:
         url = f"{TELEGRAM_API_URL}/deleteWebhook"
-        response = requests.post(url, timeout=10)
+        response = _session.post(url, timeout=10)
         result = response.json()
         ok = result.get("ok", False)
         if ok:
@@ -307,7 +525,7 @@ async def get_webhook_info():
     logger.info("🔍 กำลังตรวจสอบ Telegram webhook info...")
     try:
         url = f"{TELEGRAM_API_URL}/getWebhookInfo"
-        response = requests.get(url, timeout=10)
+        response = _session.get(url, timeout=10)
         result = response.json()
         if result.get("ok"):
             info = result.get("result", {})
@@ -323,3 +541,75 @@ async def get_webhook_info():
     except Exception as e:
         logger.exception(f"❌ Exception ขณะดึง webhook info: {e}")
         return None
+
+
+def _save_offset(path: Path, offset: int):
+    """เขียน offset แบบ atomic — เขียนไฟล์ temp แล้ว os.replace ทับ
+
+    เขียนตรงๆ แล้ว crash กลางคันจะได้ไฟล์ขาด → อ่าน offset เพี้ยน
+    และประมวลผล update ซ้ำ (ผู้ใช้ได้ข้อความเบิ้ล)
+    """
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(str(offset))
+    os.replace(tmp, path)
+
+
+async def run_long_polling(offset_file: Optional["Path"] = None):
+    """รับ update แบบ long polling — ทางเลือกแทน webhook (dev/ไม่มี ngrok)
+
+    ส่ง timeout=25 ให้ Telegram hold connection ฝั่ง server จนมี update
+    (~3 call/นาที แทน short-poll ถี่ๆ และ latency แทบเป็นศูนย์)
+    offset persist ลงไฟล์เพื่อไม่ประมวลผล update ซ้ำหลัง restart
+    """
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ ไม่สามารถเริ่ม polling: TELEGRAM_BOT_TOKEN ไม่ได้ตั้งค่า")
+        return
+
+    # ลบ webhook ก่อน — Telegram ไม่ยอมให้ getUpdates พร้อมกับ webhook
+    await delete_webhook()
+
+    offset = 0
+    if offset_file is not None and offset_file.exists():
+        try:
+            offset = int(offset_file.read_text().strip())
+            logger.info(f"📍 เริ่ม polling ต่อจาก offset={offset}")
+        except ValueError:
+            offset = 0
+
+    client = _get_async_client()
+    start_sender_workers()
+    logger.info("🤖 เริ่ม Telegram long polling (timeout 25s)...")
+
+    while True:
+        try:
+            response = await client.get(
+                f"{TELEGRAM_API_URL}/getUpdates",
+                params={
+                    "offset": offset,
+                    "timeout": 25,
+                    "limit": 100,
+                    "allowed_updates": orjson.dumps(["message"]).decode(),
+                },
+                timeout=30,
+            )
+            data = response.json()
+
+            if not data.get("ok"):
+                logger.error(f"❌ getUpdates ล้มเหลว: {data}")
+                await asyncio.sleep(5)
+                continue
+
+            updates = data.get("result", [])
+            for update in updates:
+                await process_update(update)
+                offset = update["update_id"] + 1
+
+            # persist ต่อ batch (ไม่ใช่ต่อ update) — coalesce การเขียนดิสก์
+            if updates and offset_file is not None:
+                _save_offset(offset_file, offset)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌ Error ระหว่าง polling: {e}")
+            await asyncio.sleep(5)
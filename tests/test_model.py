@@ -26,12 +26,17 @@ test_dirs = [
     Path("C:/Users/ADMINS/Downloads/Dataset/test"),
 ]
 
+# เดินทีเดียวแล้วกรองนามสกุลเอง + หยุดที่ไฟล์แรก — dataset ใหญ่ไม่ต้อง
+# walk ซ้ำสองรอบหรือเก็บ list ทั้งหมด
+_IMG_EXTS = {".jpg", ".jpeg", ".png"}
+
 test_img = None
 for d in test_dirs:
     if d.exists():
-        imgs = list(d.rglob("*.jpg")) + list(d.rglob("*.png"))
-        if imgs:
-            test_img = imgs[0]
+        test_img = next(
+            (p for p in d.rglob("*") if p.suffix.lower() in _IMG_EXTS), None
+        )
+        if test_img:
             break
 
 if test_img:
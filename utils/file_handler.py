@@ -4,7 +4,11 @@ File Handler Utilities
 """
 
 import os
+import time
 import shutil
+import asyncio
+import aiofiles
+import itertools
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List, Dict
@@ -19,56 +23,73 @@ MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
 
 
 
+_TYPE_MAPPING = {
+    'vegetable': 'vegetables',
+    'vegetables': 'vegetables',
+    'disease': 'diseases',
+    'diseases': 'diseases',
+    'pest': 'pests',
+    'pests': 'pests',
+    'diseases_pest': 'diseases_pests',
+    'plot': 'plots',
+    'plots': 'plots',
+    'user': 'users',
+    'users': 'users',
+    'detection': 'detections',
+    'detections': 'detections',
+    'cctv': 'cctv',
+    'harvest': 'harvests',
+    'harvests': 'harvests',
+    'upload': 'uploads',
+    'uploads': 'uploads',
+    'temp': 'temp',
+}
+
+# ตารางประเภท → Path สำเร็จรูป สร้างครั้งเดียวตอน import — lookup เดียวจบ
+# ไม่ต้องสร้าง dict + ต่อ Path ใหม่ทุกครั้งที่ save/delete
+_DIR_TABLE = {k: BASE_IMG_DIR / v for k, v in _TYPE_MAPPING.items()}
+# Special case: vegetable gallery อยู่ static/img/vegetables (ไม่ใช่ images)
+_DIR_TABLE['vegetable_gallery'] = Path("static/img/vegetables")
+_DEFAULT_DIR = BASE_IMG_DIR / 'uploads'
+
+
 def get_image_dir(image_type: str) -> Path:
     """
     ดึง path ของโฟลเดอร์รูปภาพตามประเภท
-    
+
     Args:
         image_type: ประเภทรูปภาพ (vegetables, diseases, pests, plots, users, detections, cctv, harvests)
-    
+
     Returns:
         Path object
     """
-    # Special case for vegetable gallery (static/img/vegetables)
-    if image_type == 'vegetable_gallery':
-        # ใช้ Path แบบ absolute หรือ relative to root โปรเจกต์
-        # ถ้าต้องการ D:\pang\project\backend_fastapi\static\img\vegetables
-        # ให้ใช้ Path("static/img/vegetables") เพราะ BASE_IMG_DIR = static/images
-        return Path("static/img/vegetables")
-        
-    type_mapping = {
-        'vegetable': 'vegetables',
-        'vegetables': 'vegetables',
-        'disease': 'diseases',
-        'diseases': 'diseases',
-        'pest': 'pests',
-        'pests': 'pests',
-        'diseases_pest': 'diseases_pests',
-        'plot': 'plots',
-        'plots': 'plots',
-        'user': 'users',
-        'users': 'users',
-        'detection': 'detections',
-        'detections': 'detections',
-        'cctv': 'cctv',
-        'harvest': 'harvests',
-        'harvests': 'harvests',
-        'upload': 'uploads',
-        'uploads': 'uploads',
-        'temp': 'temp',
-    }
-    
-    folder_name = type_mapping.get(image_type.lower(), 'uploads')
-    return BASE_IMG_DIR / folder_name
+    return _DIR_TABLE.get(image_type.lower(), _DEFAULT_DIR)
+
+
+# ลายเซ็นไฟล์ภาพ (magic bytes) ของนามสกุลที่รองรับ — content_type เป็น
+# header ที่ client กำหนดเองจึงเชื่อไม่ได้
+_IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",        # JPEG
+    b"\x89PNG\r\n\x1a\n",   # PNG
+)
+
+
+def _is_image_head(head: bytes) -> bool:
+    """เช็ค magic bytes ว่าเป็นภาพที่รองรับ (JPEG / PNG / WEBP)"""
+    if head.startswith(_IMAGE_SIGNATURES):
+        return True
+    # WEBP = RIFF container ที่ระบุ fourcc "WEBP" ไว้ที่ byte 8-11 —
+    # เช็คแค่ "RIFF" ไม่พอ ไฟล์ WAV/AVI ก็ขึ้นต้นแบบเดียวกัน
+    return head.startswith(b"RIFF") and head[8:12] == b"WEBP"
 
 
-def validate_image_file(file: UploadFile) -> bool:
+async def validate_image_file(file: UploadFile) -> bool:
     """
-    ตรวจสอบไฟล์รูปภาพ
-    
+    ตรวจสอบไฟล์รูปภาพ (นามสกุล + magic bytes)
+
     Args:
         file: UploadFile object
-    
+
     Returns:
         True if valid, raises HTTPException if invalid
     """
@@ -79,18 +100,42 @@ def validate_image_file(file: UploadFile) -> bool:
             status_code=400,
             detail=f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
         )
-    
+
     # Check content type
     if not file.content_type.startswith('image/'):
         raise HTTPException(
             status_code=400,
             detail="File must be an image"
         )
-    
+
+    # ดูไบต์แรกจริงๆ ของไฟล์ — ตัดไฟล์ขยะทิ้งก่อนเขียนลงดิสก์/เข้าโมเดล
+    head = await file.read(12)
+    await file.seek(0)
+    if not _is_image_head(head):
+        raise HTTPException(
+            status_code=400,
+            detail="File content is not a valid image"
+        )
+
     return True
 
 
 
+_PREFIX_MAPPING = {
+    'vegetable': 'veg',
+    'disease': 'disease',
+    'pest': 'pest',
+    'plot': 'plot',
+    'user': 'user',
+    'detection': 'detection',
+    'cctv': 'cctv',
+    'harvest': 'harvest',
+}
+
+# counter กันชื่อชนใน fallback — atomic ใน CPython ไม่ต้องใช้ lock
+_filename_counter = itertools.count()
+
+
 def generate_filename(
     entity_type: str,
     entity_id: str,
@@ -116,24 +161,10 @@ def generate_filename(
         return f"{entity_id}_{index}{ext}"
     
     # กรณีเดิม (Fallback)
-    timestamp = int(datetime.now().timestamp())
-    
-    prefix_mapping = {
-        'vegetable': 'veg',
-        'disease': 'disease',
-        'pest': 'pest',
-        'plot': 'plot',
-        'user': 'user',
-        'detection': 'detection',
-        'cctv': 'cctv',
-        'harvest': 'harvest',
-    }
-    
-    prefix = prefix_mapping.get(entity_type.lower(), 'img')
-    # เพิ่ม random suffix กันซ้ำกรณี timestamp ชนกัน (fallback)
-    import random
-    rand = random.randint(100, 999)
-    return f"{prefix}_{entity_id}_{timestamp}_{rand}{ext}"
+    prefix = _PREFIX_MAPPING.get(entity_type.lower(), 'img')
+    # time_ns (ละเอียดระดับ ns) + counter วิ่งขึ้นเรื่อยๆ — ไม่ชนกันแม้
+    # อัปโหลดพร้อมกันหลายไฟล์ในวินาทีเดียว (สุ่ม 3 หลักเดิมชนได้)
+    return f"{prefix}_{entity_id}_{time.time_ns()}_{next(_filename_counter)}{ext}"
 
 
 
@@ -158,7 +189,7 @@ async def save_image(
         path ของไฟล์ที่บันทึก (relative to root)
     """
     # Validate file
-    validate_image_file(file)
+    await validate_image_file(file)
     
     # Get directory
     img_dir = get_image_dir(image_type)
@@ -172,72 +203,72 @@ async def save_image(
     file_path = img_dir / filename
     
     try:
-        contents = await file.read()
-        
-        # Check file size
-        if len(contents) > MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File too large. Max size: {MAX_FILE_SIZE / (1024*1024)} MB"
-            )
-        
-        with open(file_path, 'wb') as f:
-            f.write(contents)
-        
+        # เขียนเป็น chunk — ไม่ buffer ทั้งไฟล์ใน memory และเช็คขนาดไปด้วย
+        # (ไฟล์เกินขนาดถูกตัดจบก่อนอ่านครบ ไม่ต้องรอทั้ง 10MB)
+        total = 0
+        async with aiofiles.open(file_path, 'wb') as f:
+            while chunk := await file.read(1 << 20):
+                total += len(chunk)
+                if total > MAX_FILE_SIZE:
+                    file_path.unlink(missing_ok=True)
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"File too large. Max size: {MAX_FILE_SIZE / (1024*1024)} MB"
+                    )
+                await f.write(chunk)
+
         # Return path relative to root
         # Check if img_dir starts with "static/" to return cleaner path
         path_str = str(file_path).replace("\\", "/")
         if path_str.startswith("static/"):
             return path_str
         return f"static/{path_str}" if not path_str.startswith("static") else path_str
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save image: {str(e)}")
 
 
 
+# ตาราง prefix → root directory ของ path ที่ client ส่งมา
+# (เช็คเรียงลำดับ — prefix ยาวกว่าต้องมาก่อน img/)
+_PATH_RULES = (
+    ('static/images/', Path("static/images")),
+    ('static/img/', Path("static/img")),
+    ('img/', BASE_IMG_DIR),
+)
+
+
+def _resolve_image_path(image_path: str) -> Path:
+    """แปลง path ที่ client ส่งมาเป็น Path จริงบนดิสก์ (ตัดสินจาก prefix)"""
+    for prefix, root in _PATH_RULES:
+        if image_path.startswith(prefix):
+            return root / image_path.removeprefix(prefix)
+    # ไม่มี prefix -> อยู่ใต้ static/images/
+    return BASE_IMG_DIR / image_path
+
+
+def _safe_unlink(path: Path) -> bool:
+    """ลบไฟล์ตรงๆ — unlink ครั้งเดียวแทน exists() + unlink() (ลด syscall)"""
+    try:
+        path.unlink()
+        return True
+    except OSError:
+        return False
+
+
 def delete_image(image_path: str) -> bool:
     """
     ลบไฟล์รูปภาพ
-    
+
     Args:
         image_path: path ของรูปภาพ (relative to static/)
-    
+
     Returns:
         True if deleted, False if not found
     """
-    try:
-        # รองรับหลายรูปแบบ path
-        possible_paths = []
-        
-        # แบบที่ 1: path เริ่มต้นด้วย img/ -> static/img/...
-        if image_path.startswith('img/'):
-            possible_paths.append(BASE_IMG_DIR / image_path.replace('img/', ''))
-        
-        # แบบที่ 2: path เริ่มต้นด้วย static/images/ -> static/images/...
-        elif image_path.startswith('static/images/'):
-            possible_paths.append(Path("static/images") / image_path.replace('static/images/', ''))
-        
-        # แบบที่ 3: path เริ่มต้นด้วย static/img/ -> static/img/...
-        elif image_path.startswith('static/img/'):
-            possible_paths.append(Path("static/img") / image_path.replace('static/img/', ''))
-        
-        # แบบที่ 4: path ไม่มี prefix -> ลองหาใน img/ และ images/
-        else:
-            possible_paths.append(BASE_IMG_DIR / image_path)
-            possible_paths.append(Path("static/images") / image_path)
-        
-        # ลบไฟล์จากทุก path ที่เป็นไปได้ (จริงๆ จะมีอยู่ที่เดียว)
-        deleted = False
-        for full_path in possible_paths:
-            if full_path.exists():
-                full_path.unlink()
-                deleted = True
-                break
-        
-        return deleted
-    except Exception:
-        return False
+    return _safe_unlink(_resolve_image_path(image_path))
 
 
 def get_image_url(image_path: str) -> str:
@@ -252,17 +283,17 @@ def get_image_url(image_path: str) -> str:
     """
     if not image_path:
         return ""
-    
+
     # If already starts with /static/, return as is
     if image_path.startswith('/static/'):
         return image_path
-    
+
     # If starts with static/ (without leading slash), add leading slash
     if image_path.startswith('static/'):
-        return f"/{image_path}"
-    
+        return '/' + image_path
+
     # Add /static/ prefix
-    return f"/static/{image_path}"
+    return '/static/' + image_path
 
 
 def move_temp_image(temp_filename: str, target_type: str, entity_id: str) -> str:
@@ -300,30 +331,49 @@ def move_temp_image(temp_filename: str, target_type: str, entity_id: str) -> str
         raise HTTPException(status_code=500, detail=f"Failed to move image: {str(e)}")
 
 
+def _cleanup_folder_sync(folder: Path, cutoff_ts: float):
+    """ลบไฟล์ที่ mtime เก่ากว่า cutoff ด้วย os.scandir
+
+    DirEntry cache ผล stat ไว้ให้ — ถูกกว่า iterdir() + Path.stat()
+    ที่ allocate Path object และยิง syscall แยกต่อไฟล์
+    """
+    if not folder.exists():
+        return
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
 def cleanup_old_images(days: int = 7):
     """
     ลบไฟล์เก่าในโฟลเดอร์ temp และ uploads
-    
+
     Args:
         days: จำนวนวันที่เก็บไว้
     """
     from datetime import timedelta
-    
-    cutoff_time = datetime.now() - timedelta(days=days)
-    
+
+    cutoff_ts = (datetime.now() - timedelta(days=days)).timestamp()
+
     for folder_name in ['temp', 'uploads']:
-        folder = get_image_dir(folder_name)
-        if not folder.exists():
-            continue
-        
-        for file_path in folder.iterdir():
-            if file_path.is_file():
-                file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-                if file_mtime < cutoff_time:
-                    try:
-                        file_path.unlink()
-                    except Exception:
-                        pass
+        _cleanup_folder_sync(get_image_dir(folder_name), cutoff_ts)
+
+
+async def cleanup_old_images_async(days: int = 7):
+    """ลบไฟล์เก่าแบบไม่ block event loop — แต่ละโฟลเดอร์รันใน thread แยก"""
+    from datetime import timedelta
+
+    cutoff_ts = (datetime.now() - timedelta(days=days)).timestamp()
+    await asyncio.gather(
+        *(
+            asyncio.to_thread(_cleanup_folder_sync, get_image_dir(f), cutoff_ts)
+            for f in ('temp', 'uploads')
+        )
+    )
 
 
 # ============== Multiple Images Handler ==============
@@ -401,7 +451,29 @@ def delete_multiple_images(image_paths: List[str]) -> Dict[str, bool]:
     return results
 
 
-def validate_multiple_images(files: List[UploadFile]) -> bool:
+async def delete_multiple_images_async(image_paths: List[str]) -> Dict[str, bool]:
+    """
+    ลบหลายไฟล์รูปภาพแบบขนานใน thread pool (ไม่ block event loop)
+
+    unlink เป็น syscall — ยิงพร้อมกันผ่าน asyncio.to_thread แทนไล่ลบ
+    ทีละไฟล์บน event loop thread
+
+    Args:
+        image_paths: List ของ path รูปภาพที่ต้องการลบ
+
+    Returns:
+        Dict ที่มี key เป็น path และ value เป็น boolean (True=ลบสำเร็จ, False=ไม่พบไฟล์)
+    """
+    if not image_paths:
+        return {}
+    resolved = [_resolve_image_path(p) for p in image_paths]
+    results = await asyncio.gather(
+        *(asyncio.to_thread(_safe_unlink, p) for p in resolved)
+    )
+    return dict(zip(image_paths, results))
+
+
+async def validate_multiple_images(files: List[UploadFile]) -> bool:
     """
     ตรวจสอบไฟล์รูปภาพหลายไฟล์
     
@@ -419,6 +491,6 @@ def validate_multiple_images(files: List[UploadFile]) -> bool:
     
     for file in files:
         if file and file.filename:
-            validate_image_file(file)
-    
+            await validate_image_file(file)
+
     return True